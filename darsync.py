@@ -1,20 +1,74 @@
 #!/usr/bin/env python3
 
 import argparse
+import bisect
+import collections
+import contextlib
+import heapq
+import itertools
+import json
+import math
 import os
+import pickle
+import posixpath
+import pwd
+import random
+import re
+import resource
+import shlex
 import sys
-import pdb
+import platform
+import grp
 import gzip
-import readline
+import glob
+import hashlib
+import shutil
 import stat
+import struct
 import subprocess
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 # Define a list of file extensions that are considered 'uncompressed'
 UNCOMPRESSED_FILE_EXTENSIONS = [".sam", ".vcf", ".fq", ".fastq", ".fasta", ".txt", ".fa"]  # Add your own uncompressed file extensions
 
-def msg(id, lang='en', **kwargs):
-    """ Returns a message in the specified language """
-    msgs = {'en':
+# File name suffixes and the category they put a file in. Only the 'uncompressed' files are reported
+# as files to compress, the other categories are only counted. More rules can be added with check --rules.
+CLASSIFIER_RULES = dict.fromkeys(UNCOMPRESSED_FILE_EXTENSIONS, 'uncompressed')
+CLASSIFIER_RULES.update(dict.fromkeys([".gz", ".bgz", ".bz2", ".xz", ".zst", ".zip", ".7z", ".bam", ".cram", ".bcf"], 'compressed'))
+CLASSIFIER_RULES.update(dict.fromkeys([".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz", ".tar.zst"], 'archive'))
+
+# File headers of compressed formats, files starting with anything else that looks like text are uncompressed
+COMPRESSED_MAGIC = (b"\x1f\x8b", b"BZh", b"\xfd7zXZ\x00", b"\x28\xb5\x2f\xfd", b"PK\x03\x04", b"7z\xbc\xaf\x27\x1c", b"CRAM")
+TEXT_BYTES       = bytes(range(32, 127)) + b"\t\n\r\f\b"
+
+# Assumed transfer rate from UPPMAX to Dardel, used to estimate transfer times
+TRANSFER_RATE = 100 * 1024 ** 2 # 100MB/s
+
+# Model of how long a transfer takes, used to size the walltime of the SLURM job. Each stream sends
+# bandwidth bytes/s, but together they can not send more than link_bandwidth, and every file and
+# directory costs per_file_overhead seconds on top of that. Can be tuned per site with gen --model.
+TRANSFER_MODEL = {'bandwidth':         TRANSFER_RATE,
+                  'link_bandwidth':    1024 ** 3,    # 1GB/s
+                  'per_file_overhead': 0.005,        # 5ms
+                  'tar_file_overhead': 0.0002,       # files in crowded directories sent as tar archives
+                  'hash_rate':         500 * 1024 ** 2, # checksum rate when verifying the transfer
+                  'safety_factor':     1.5,
+                  'min_time':          3600,         # 1 hour
+                  'max_time':          10 * 86400,   # 10 days, the longest a job can run
+                  'target_time':       86400,        # with gen --auto-partitions, aim for transfers of 1 day
+                  'max_streams':       16,
+                  'ssh_cipher':        None,         # ssh -c, from darsync bench-link
+                  'rsync_compress':    False,        # rsync -z, from darsync bench-link
+                  }
+
+# The messages printed by the subcommands, by language
+MESSAGES = {'en':
                 {
                     "script_intro": """
 
@@ -87,6 +141,10 @@ A file containing file ownership information,
 {ownership_file_path},
 has been created. This file can be used to make sure that the
 file ownership (user/group) will look the same on Dardel as it does here. 
+After the transfer, apply it on Dardel with
+
+darsync restore-ownership /path/on/dardel/{ownership_file_name} --dest-dir /path/on/dardel
+
 See http://docs.uppmax.uu.se/cluster_guides/dardel_migration/#52-check-for-problems 
 for more info about this.
     """,
@@ -131,7 +189,7 @@ Created SLURM script: {outfile}
 
 containing the following command:
 
-rsync -e "ssh -i {ssh_key} -o StrictHostKeyChecking=no" -acPuv {local_dir}/ {username}@{hostname}:{remote_dir}
+{rsync_command}
 
 
 To test if the generated file works, run
@@ -217,6 +275,9 @@ Specify SLURM script path: """,
 {large_count}\tfiles larger than {human_readable_size_limit} found
 {human_readable_total_size}\ttotal size of all uncompressed files
 
+The largest files with uncompressed file extensions:
+{largest_files}
+
 If the total file size of all files with uncompressed file extensions exceed {human_readable_size_limit}
 you should consider compressing them or converting them to a better file format.
 Doing that will save you disk space as compressed formats are roughly 75% smaller 
@@ -230,6 +291,84 @@ see the file {prefix}.uncompressed
 
 See http://docs.uppmax.uu.se/cluster_guides/dardel_migration/#52-check-for-problems for more info about this.
 
+-----------------------------------------------------------------""",
+                    "compression_estimate": """\n\n\nCompression estimate, based on compressing samples of {sampled_files} files ({human_readable_sampled_size}) in {elapsed:.1f} seconds:
+
+Compressing all files with uncompressed file extensions would save about {human_readable_save_size} ({save_percent:.0f}%),
+which would make the transfer roughly {human_readable_save_time} faster at {human_readable_transfer_rate}/s.
+
+Estimated savings per file extension:
+
+saved\tratio\ttotal size\textension
+{extension_table}{not_worth_note}
+
+To see the estimated savings for each directory, largest first,
+see the file {prefix}.compression
+
+-----------------------------------------------------------------""",
+                    "check_stats": """\n\n\nTiming summary: {files} files in {seconds:.1f} seconds, {files_per_second:.0f} files/s, {stat_calls} lstat calls.
+
+seconds\tspent on
+{timing_table}
+
+Listing directories and lstat are time spent waiting for the file system, matching
+extensions and writing the ownership file are darsync's own work. With more than one
+job the listing and lstat times are summed over all threads, so they can add up to
+more than the total time.
+
+The summary is saved as JSON in {prefix}.stats.json
+-----------------------------------------------------------------""",
+                    "category_totals": """\n\n\nFiles per category, based on their file name extensions:
+
+files\tsize\tcategory
+{category_table}
+{sniffed}
+-----------------------------------------------------------------""",
+                    "hard_links": """\n\n\n{n_groups} files have more than one hard link in the directory, {n_links} paths in total.
+
+Unless hard links are kept, each path is transferred as a separate copy, which would send
+{human_readable_hard_link_size} more than needed and use that much more space on Dardel. darsync gen keeps
+hard links (rsync -H) when this report exists.
+
+To see the linked paths of each file, largest first,
+see the file {prefix}.hardlinks
+-----------------------------------------------------------------""",
+                    "usage": """\n\n\nSpace used by the {n_files} regular files:
+
+{human_readable_size}\ttheir size, which is what rsync reads and sends
+{human_readable_allocated}\tallocated for them on disk
+{sparse_files}\tsparse files, with {human_readable_holes} of holes
+{sparse_note}
+Size of the files by when they were last modified and accessed:
+
+within\tmodified\taccessed
+{age_table}
+
+{human_readable_hot} of the files were modified or accessed within {hot_days} days, darsync gen --hot-first
+sends them first.
+
+To see the totals of each directory,
+see the file {prefix}.usage.gz
+-----------------------------------------------------------------""",
+                    "sparse_note": """
+The holes in sparse files are sent as zeros and written out in full on Dardel, unless rsync
+is told to keep them (--sparse). darsync gen does that when this report exists.
+
+To see the sparse files, most holes first,
+see the file {prefix}.sparse
+""",
+                    "duplicates": """\n\n\n{n_groups} files of at least {human_readable_min_size} have identical copies in the directory, {n_files} files in total,
+found in {elapsed:.1f} seconds.
+
+Keeping only one copy of each, or replacing the copies with links to it, would save {human_readable_duplicate_size}.
+
+The largest savings:
+
+saved\tcopies\tfile
+{largest_duplicates}
+
+To see all groups of identical files, largest savings first,
+see the file {prefix}.duplicates
 -----------------------------------------------------------------""",
                     "too_many_files_warning": """\n\n\nWARNING: Total number of files, or number of files in a single directory
 exceeding threshold. See http://docs.uppmax.uu.se/cluster_guides/dardel_migration/#52-check-for-problems for more info about this.
@@ -244,81 +383,1926 @@ see the file {prefix}.dir_n_files
 
     }
 
-    
-    return msgs[lang][id].format(**kwargs)
-
-
-
-# Enable tab completion
-readline.parse_and_bind("tab: complete")
-
-# Change word delimiters
-readline.set_completer_delims(' \t\n=/')
-
-# Set the autocomplete function
-def complete_path(text, state):
-    # Get the current input text
-    line = readline.get_line_buffer()
-    # Expand any home folder tildes
-    line = os.path.expanduser(line)
-    # Split the line into individual arguments
-    args = line.split()
-    # Get the last argument (the one being completed)
-    last_arg = args[-1] if len(args) > 0 else ""
-
-    # Get the directory path and the partial file name
-    dir_path, partial_name = os.path.split(last_arg)
-
-    # Get a list of possible matches
-    matches = [f for f in os.listdir(dir_path) if f.startswith(partial_name)] 
-
-    # If it's the first tab-completion
-    if state == 0:
-        # If there's only a single match
-        if len(matches) == 1:
-            return matches[0] + "/"
-        # Otherwise, return the first match
-        elif len(matches) > 0:
-            return matches[0]
-    # For subsequent tab-completions
-    elif state < len(matches):
-        # If there's only a single match
-        if len(matches) == 1:
-            return matches[state] + "/"
-        # Otherwise, return the next match
-        else:
-            return matches[state]
 
-# Set the autocomplete function for the input() function
-readline.set_completer(complete_path)
+
+def msg(id, lang='en', **kwargs):
+    """ Returns a message in the specified language """
+    return MESSAGES[lang][id].format(**kwargs)
+
+
+
+class PathCompleter:
+    """ Tab completion of paths for the interactive prompts, with the names in a directory cached until it changes """
+
+    def __init__(self, max_entries=200000, max_matches=1000, max_dirs=16):
+        self.max_entries = max_entries
+        self.max_matches = max_matches
+        self.max_dirs    = max_dirs
+        # dir_path -> (mtime_ns, sorted names, names of subdirectories), least recently used first
+        self.cache   = collections.OrderedDict()
+        # dir_path -> mtime_ns of directories found to be too large to cache
+        self.large   = {}
+        self.matches = []
+
+    @staticmethod
+    def is_dir(entry):
+        """ Directories and symlinks to directories are completed with a trailing / """
+        try:
+            return entry.is_dir()
+        except OSError:
+            return False
+
+    def listing(self, dir_path):
+        """ Return the sorted names in a directory and the set of its subdirectories, or None if it is too large to cache """
+        mtime_ns = os.stat(dir_path).st_mtime_ns
+        if self.large.get(dir_path) == mtime_ns:
+            return None
+        cached = self.cache.get(dir_path)
+        if cached and cached[0] == mtime_ns:
+            self.cache.move_to_end(dir_path)
+            return cached[1], cached[2]
+
+        names = []
+        dirs  = set()
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if len(names) == self.max_entries:
+                    self.large[dir_path] = mtime_ns
+                    return None
+                names.append(entry.name)
+                if self.is_dir(entry):
+                    dirs.add(entry.name)
+        names.sort()
+
+        # a directory changed within the same mtime tick as it was read could look unchanged later
+        if time.time_ns() - mtime_ns > ScanIndex.RACY_NS:
+            self.cache[dir_path] = (mtime_ns, names, dirs)
+            while len(self.cache) > self.max_dirs:
+                self.cache.popitem(last=False)
+        return names, dirs
+
+    def find_matches(self, dir_path, partial_name):
+        """ Return the names in dir_path starting with partial_name, with a / after directories """
+        cached = self.listing(dir_path)
+
+        # read directories too large to cache lazily, and stop when there are enough matches to show
+        if cached is None:
+            matches = []
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    if entry.name.startswith(partial_name):
+                        matches.append(entry.name + "/" if self.is_dir(entry) else entry.name)
+                        if len(matches) == self.max_matches:
+                            break
+            return sorted(matches)
+
+        names, dirs = cached
+        start   = bisect.bisect_left(names, partial_name)
+        matches = []
+        for name in names[start:start + self.max_matches]:
+            if not name.startswith(partial_name):
+                break
+            matches.append(name + "/" if name in dirs else name)
+        return matches
+
+    def complete(self, text, state):
+        """ readline completer, the matches are found when Tab is pressed (state 0) and then returned one by one """
+        if state == 0:
+            import readline
+            # complete the last argument on the line, with any home folder tildes expanded
+            args     = os.path.expanduser(readline.get_line_buffer()).split()
+            last_arg = args[-1] if len(args) > 0 else ""
+
+            # Get the directory path and the partial file name
+            dir_path, partial_name = os.path.split(last_arg)
+            try:
+                self.matches = self.find_matches(dir_path or ".", partial_name)
+            except OSError:
+                self.matches = []
+        return self.matches[state] if state < len(self.matches) else None
+
+
+
+def enable_completion():
+    """ Set up tab completion of paths for the interactive questions, only done when reading them from a terminal """
+    import readline
+
+    # Enable tab completion
+    readline.parse_and_bind("tab: complete")
+
+    # Change word delimiters
+    readline.set_completer_delims(' \t\n=/')
+
+    # Set the autocomplete function for the input() function
+    readline.set_completer(PathCompleter().complete)
+
+
+
+def ask(args, id, **kwargs):
+    """ Ask for an option that was not given, or raise ValueError if there is no one to ask, as when called through the API """
+    if not args.interactive:
+        raise ValueError(f"missing option --{id[len('input_'):].replace('_', '-')}")
+    return input(msg(id, **kwargs))
 
 
 def human_readable_size(size, units=('B', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB', 'ZB', 'YB')):
     """ Returns a human readable string representation of bytes """
     return "{0:.1f} {1}".format(size, units[0]) if size < 1024 else human_readable_size(size / 1024, units[1:])
 
+def read_transfer_model(path=None, cluster=None):
+    """ Return the transfer model, updated with the values in a JSON file and its section for cluster """
+    model = dict(TRANSFER_MODEL)
+    path  = os.path.expanduser(path or "~/.darsync_model.json")
+    if not os.path.isfile(path):
+        return model
+    with open(path) as f:
+        values = json.load(f)
+    model.update((key, value) for key, value in values.items() if key in TRANSFER_MODEL)
+    model.update((key, value) for key, value in values.get(cluster, {}).items() if key in TRANSFER_MODEL)
+    return model
+
+
+
+def predict_transfer(model, n_entries, n_bytes, streams=1, packed_files=0, packed_bytes=0, verify=False):
+    """ Predict how many seconds a transfer takes with the transfer model """
+    streams   = max(streams, 1)
+    bandwidth = min(model['bandwidth'], model['link_bandwidth'] / streams)
+    seconds   = ((n_entries - packed_files) * model['per_file_overhead'] + (n_bytes - packed_bytes) / bandwidth) / streams
+    seconds  += packed_files * model['tar_file_overhead'] + packed_bytes / model['bandwidth']
+    if verify:
+        seconds += n_bytes / model['hash_rate']
+    return seconds
+
+
+
+def slurm_time(seconds):
+    """ Format seconds as a SLURM time limit, D-HH:MM:SS """
+    seconds = int(seconds)
+    return f"{seconds // 86400}-{seconds % 86400 // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+
+def human_readable_time(seconds):
+    """ Returns a human readable string representation of a duration in seconds """
+    for unit, length in (('days', 86400), ('hours', 3600), ('minutes', 60)):
+        if seconds >= length:
+            return f"{seconds / length:.1f} {unit}"
+    return f"{seconds:.0f} seconds"
+
+
+
+class Classifier:
+    """ Puts files in categories by the longest suffix of their name that there is a rule for """
+
+    def __init__(self, rules=CLASSIFIER_RULES, rules_file=None):
+        self.rules = dict(rules)
+        if rules_file:
+            self.read_rules(rules_file)
+        # the most suffixes to try for a file name
+        self.max_dots = max((suffix.count('.') for suffix in self.rules), default=1)
+
+
+    def read_rules(self, path):
+        """ Add the '.suffix category' rules in a file, replacing earlier rules for the same suffix """
+        with open(path) as f:
+            for line_number, line in enumerate(f, 1):
+                fields = line.split('#', 1)[0].split()
+                if not fields:
+                    continue
+                if len(fields) != 2 or not fields[0].startswith('.'):
+                    raise ValueError(f"{path}, line {line_number}: expected a suffix starting with a dot and a category")
+                self.rules[fields[0]] = fields[1]
+
+
+    def match(self, name):
+        """ Return (suffix, category) for the longest suffix of a file name there is a rule for, or None """
+        match = None
+        end   = len(name)
+        for _ in range(self.max_dots):
+            dot = name.rfind('.', 0, end)
+            if dot < 0:
+                break
+            category = self.rules.get(name[dot:])
+            if category is not None:
+                match = name[dot:], category
+            end = dot
+        return match
+
+
+    def category(self, name):
+        """ Return the category of a file name, or 'other' """
+        # the common case of a single suffix
+        dot = name.rfind('.')
+        if dot < 0:
+            return 'other'
+        if self.max_dots == 1:
+            return self.rules.get(name[dot:], 'other')
+        match = self.match(name)
+        return match[1] if match else 'other'
+
+
+    def suffixes(self, category):
+        """ Return the suffixes of the rules for a category """
+        return [suffix for suffix, rule_category in self.rules.items() if rule_category == category]
+
+
+
+default_classifier = Classifier()
+
+
+
+def sniff_uncompressed(path, header_size=4096):
+    """ Return True if a file starts with text rather than one of the known compressed formats """
+    try:
+        with open(path, 'rb', buffering=0) as f:
+            header = f.read(header_size)
+    except OSError:
+        return False
+    if not header or header.startswith(COMPRESSED_MAGIC):
+        return False
+    # allow the odd byte that is not text, e.g. in a latin-1 encoded file
+    return len(header.translate(None, TEXT_BYTES)) <= len(header) // 100
+
+
+
+def uncompressed_extension(file, classifier=None):
+    """ Returns which of the suffixes in the classifier's rules a file name ends with, or its own extension """
+    match = (classifier or default_classifier).match(os.path.basename(file))
+    return match[0] if match else os.path.splitext(file)[1] or "(none)"
+
+
+
+def sample_compression(path, size, sample_size, deadline):
+    """ Compress samples from four places in a file and return (bytes read, compressed size), or None """
+    if time.time() > deadline:
+        return None
+    slice_size = max(sample_size // 4, 1)
+    offsets    = sorted(set(min(size * i // 4, max(size - slice_size, 0)) for i in range(4)))
+    try:
+        with open(path, 'rb', buffering=0) as f:
+            sample = b''
+            for offset in offsets:
+                f.seek(offset)
+                sample += f.read(slice_size)
+    except OSError:
+        return None
+    # the same level gzip uses by default
+    return len(sample), len(zlib.compress(sample, 6))
+
+
+
+def estimate_compression(uncompressed_files, sample_size=1024 ** 2, byte_budget=1024 ** 3, time_budget=300, jobs=4, classifier=None):
+    """ Estimate the savings of compressing the 'uncompressed' files by compressing samples of them within a budget.
+        Returns (n files, n bytes, seconds, per extension, per directory) with [size, saved, sampled, compressed] in each
+    """
+    start    = time.time()
+    deadline = start + time_budget
+
+    # queues of files per extension, largest first, no longer than the number of files the budget allows
+    max_queued = byte_budget // 4096 + 1
+    queues = collections.OrderedDict()
+    for path, size in uncompressed_files:
+        queue = queues.setdefault(uncompressed_extension(path, classifier), deque())
+        if size > 0 and len(queue) < max_queued:
+            queue.append((path, size))
+
+    # pick files to sample, taking turns between the extensions
+    picked = []
+    budget = byte_budget
+    while budget > 0 and any(queues.values()):
+        for queue in queues.values():
+            if queue and budget > 0:
+                path, size = queue.popleft()
+                picked.append((path, size))
+                # small files still cost at least a block read each
+                budget -= max(min(size, sample_size), 4096)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        samples = dict(zip((path for path, size in picked), executor.map(lambda file: sample_compression(file[0], file[1], sample_size, deadline), picked)))
+    samples = {path: sample for path, sample in samples.items() if sample is not None and sample[0] > 0}
+
+    # measured ratio per extension, and over all samples for extensions without any
+    ext_samples = collections.defaultdict(lambda: [0, 0])
+    for path, (raw, compressed) in samples.items():
+        ext_samples[uncompressed_extension(path, classifier)][0] += raw
+        ext_samples[uncompressed_extension(path, classifier)][1] += compressed
+    sampled_raw        = sum(raw for raw, compressed in samples.values())
+    sampled_compressed = sum(compressed for raw, compressed in samples.values())
+    overall_ratio      = sampled_compressed / sampled_raw if sampled_raw else 0.25
+    ext_ratio          = collections.defaultdict(lambda: overall_ratio, ((ext, compressed / raw if raw else overall_ratio) for ext, (raw, compressed) in ext_samples.items()))
+
+    # project the savings onto all files, using the file's own sample when there is one
+    per_ext = {}
+    per_dir = {}
+    for path, size in uncompressed_files:
+        ext = uncompressed_extension(path, classifier)
+        raw, compressed = samples.get(path, (0, 0))
+        # incompressible files grow a little when compressed, they save nothing rather than a negative amount
+        saved = max(size * (1 - (compressed / raw if raw else ext_ratio[ext])), 0)
+        for stats, key in ((per_ext, ext), (per_dir, os.path.dirname(path))):
+            totals = stats.setdefault(key, [0, 0, 0, 0])
+            totals[0] += size
+            totals[1] += saved
+            totals[2] += raw
+            totals[3] += compressed
+
+    return len(samples), sampled_raw, time.time() - start, per_ext, per_dir
+
+
+
+class ScanStats:
+    """ Thread safe counters of the work done by a scan, timed only when timed is set """
+
+    def __init__(self):
+        self.lock     = threading.Lock()
+        self.counters = collections.Counter()
+        self.timed    = False
+
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+
+
+
+scan_stats = ScanStats()
+
+
+
+class ScanProgress:
+    """ A progress line for the check, redrawn at most every interval seconds """
+
+    def __init__(self, interval=0.5, expected_files=None, output=None):
+        self.interval       = interval
+        self.expected_files = expected_files
+        self.output         = output
+        self.start          = time.monotonic()
+        self.last           = 0
+        self.last_len       = 0
+
+
+    def update(self, dirpath, n_files, n_bytes, pending_dirs, force=False):
+        now = time.monotonic()
+        if not force and now - self.last < self.interval:
+            return
+        self.last = now
+
+        elapsed = now - self.start
+        rate    = n_files / elapsed if elapsed > 0 else 0
+        if self.expected_files and rate:
+            remaining = f"about {human_readable_time(max(self.expected_files - n_files, 0) / rate)} left"
+        else:
+            remaining = f"{pending_dirs} dirs queued"
+        line = f"\r{n_files} files, {human_readable_size(n_bytes)}, {rate:.0f} files/s, {remaining}: {dirpath}"
+        print(line + ' '*(self.last_len-len(line)), end='', flush=True, file=self.output)
+        self.last_len = len(line)
+
+
+
+class MetadataGovernor:
+    """ Limits the rate, and with adaptive=True the concurrency, of the directory listings and lstat calls of a scan """
+
+    def __init__(self, max_concurrency, min_concurrency=1, max_rate=None, adaptive=False, tolerance=2.0, window=0.5,
+                 clock=time.monotonic, sleep=time.sleep, latency_model=None):
+        self.max_concurrency = max(max_concurrency, 1)
+        self.min_concurrency = max(min(min_concurrency, self.max_concurrency), 1)
+        self.max_rate        = max_rate
+        self.adaptive        = adaptive
+        self.tolerance       = tolerance
+        self.window          = window
+        self.clock           = clock
+        self.sleep           = sleep
+        self.latency_model   = latency_model
+        self.limit           = self.min_concurrency if adaptive else self.max_concurrency
+        self.in_flight       = 0
+        self.condition       = threading.Condition()
+        # the lowest latency per operation seen, taken as the latency of the file system when it is not loaded
+        self.baseline        = None
+        self.allowed_at      = clock()
+        self.window_start    = clock()
+        self.window_ops      = 0
+        self.window_time     = 0
+        self.ops             = 0
+        # (seconds since the start, concurrency limit, latency per operation) of every window
+        self.history         = []
+        self.start           = clock()
+
+    def acquire(self):
+        """ Wait until another directory may be listed """
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+            wait = self.allowed_at - self.clock() if self.max_rate else 0
+        if wait > 0:
+            self.sleep(wait)
+
+    def simulate(self, ops):
+        """ Add the latency of the latency model, if there is one, to ops operations made now """
+        if self.latency_model is not None:
+            self.sleep(ops * self.latency_model(self.in_flight))
+
+    def release(self, ops, seconds):
+        """ Report that a directory listing made ops operations in seconds """
+        with self.condition:
+            self.in_flight -= 1
+            self.ops       += ops
+            now = self.clock()
+            # charge the operations to the rate limit afterwards, allowing bursts of up to a second
+            if self.max_rate:
+                self.allowed_at = max(self.allowed_at, now - 1) + ops / self.max_rate
+            self.window_ops  += ops
+            self.window_time += seconds
+            if now - self.window_start >= self.window and self.window_ops:
+                self.adjust(self.window_time / self.window_ops, now)
+            self.condition.notify_all()
+
+    def adjust(self, latency, now):
+        """ Additive increase, multiplicative decrease of the concurrency limit, from the latency of the last window """
+        # slowly forget the lowest latency, so a window that was fast by luck does not hold the scan back for ever
+        self.baseline = latency if self.baseline is None else min(latency, self.baseline * 1.01)
+        if self.adaptive:
+            if latency <= self.baseline * self.tolerance:
+                self.limit = min(self.limit + 1, self.max_concurrency)
+            else:
+                self.limit = max(int(self.limit * 0.7), self.min_concurrency)
+        self.history.append((now - self.start, self.limit, latency))
+        self.window_start = now
+        self.window_ops   = 0
+        self.window_time  = 0
+
+    def summary(self):
+        """ Return what the governor did, for the --stats summary """
+        seconds = self.clock() - self.start
+        limits  = [limit for elapsed, limit, latency in self.history] or [self.limit]
+        return {'max_rate': self.max_rate, 'adaptive': self.adaptive, 'ops': self.ops, 'ops_per_second': self.ops / seconds if seconds else 0,
+                'final_concurrency': self.limit, 'mean_concurrency': sum(limits) / len(limits), 'max_concurrency': self.max_concurrency,
+                'baseline_latency': self.baseline, 'history': self.history}
+
+
+
+class FakeLatency:
+    """ Simulated latency of a busy metadata server, for testing the governor """
+
+    def __init__(self, base=0.001, capacity=4):
+        self.base     = base
+        self.capacity = capacity
+
+    @classmethod
+    def parse(cls, text):
+        """ Parse a model given as BASE_MS:CAPACITY, e.g. 2:4 """
+        base, _, capacity = text.partition(':')
+        return cls(float(base) / 1000, int(capacity or 4))
+
+    def __call__(self, in_flight):
+        return self.base * max(1, in_flight / self.capacity)
+
+
+
+def governed_list_dir(dirpath, dir_info, cached_listing, governor):
+    """ list_dir, when the governor allows it, reporting how many operations it took and how long """
+    if governor is None:
+        return list_dir(dirpath, dir_info, cached_listing)
+    governor.acquire()
+    start   = time.perf_counter()
+    ops     = 1
+    try:
+        listing = list_dir(dirpath, dir_info, cached_listing)
+        if listing is not None:
+            ops += len(listing[0]) + len(listing[1])
+        governor.simulate(ops)
+    finally:
+        governor.release(ops, time.perf_counter() - start)
+    return listing
+
+
+
+def classify_entry(entry):
+    """ Return (is_dir, lstat result) of a directory entry, the way os.walk classifies it """
+    try:
+        is_dir = entry.is_dir()
+    except OSError:
+        is_dir = False
+
+    if is_dir:
+        # like os.walk, symlinked directories are listed as directories but not walked into,
+        # and the stat result is reused as the directory's own lstat when it is visited
+        try:
+            return True, entry.stat(follow_symlinks=False)
+        except OSError:
+            return True, None
+
+    return False, entry.stat(follow_symlinks=False)
+
+
+
+def scan_dir(dirpath):
+    """ List a single directory like os.walk and return its subdirectories and files with their lstat results, or None """
+    subdirs = []
+    files   = []
+    timed   = scan_stats.timed
+    start   = time.perf_counter() if timed else 0
+    stat_time = 0
+
+    try:
+        scandir_it = os.scandir(dirpath)
+    except OSError:
+        return None
+
+    with scandir_it:
+        while True:
+            try:
+                entry = next(scandir_it)
+            except StopIteration:
+                break
+            except OSError:
+                return None
+
+            if timed:
+                stat_start = time.perf_counter()
+                is_dir, info = classify_entry(entry)
+                stat_time += time.perf_counter() - stat_start
+            else:
+                is_dir, info = classify_entry(entry)
+            if not is_dir:
+                files.append((entry.name, info))
+            elif info is not None:
+                subdirs.append((entry.name, info))
+
+    scan_stats.add('stat_calls', len(subdirs) + len(files))
+    if timed:
+        scan_stats.add('stat_time', stat_time)
+        scan_stats.add('list_time', time.perf_counter() - start - stat_time)
+    return subdirs, files
+
+
+
+def iter_dir(scandir_it, subdirs, dirnames):
+    """ Yield the files of a scandir iterator one at a time, adding its subdirectories to subdirs and dirnames """
+    stat_calls = 0
+    timed      = scan_stats.timed
+    list_time  = 0
+    stat_time  = 0
+    try:
+        with scandir_it:
+            while True:
+                # only the time spent in here counts, not the time the consumer spends on the files
+                if timed:
+                    list_start = time.perf_counter()
+                try:
+                    entry = next(scandir_it)
+                except (StopIteration, OSError):
+                    return
+                if timed:
+                    stat_start = time.perf_counter()
+                    is_dir, info = classify_entry(entry)
+                    stat_end = time.perf_counter()
+                    list_time += stat_start - list_start
+                    stat_time += stat_end - stat_start
+                else:
+                    is_dir, info = classify_entry(entry)
+                stat_calls += 1
+                if not is_dir:
+                    yield entry.name, info
+                elif info is not None:
+                    subdirs.append((entry.name, info))
+                    dirnames.append(entry.name)
+    finally:
+        scan_stats.add('stat_calls', stat_calls)
+        if timed:
+            scan_stats.add('list_time', list_time)
+            scan_stats.add('stat_time', stat_time)
+
+
+
+def list_dir(dirpath, dir_info, cached_listing=None):
+    """ List a directory, or reuse the files cached_listing has for it and only lstat its subdirectories """
+    if cached_listing is not None and dir_info is not None:
+        cached = cached_listing(dirpath, dir_info)
+        if cached is not None:
+            names, files = cached
+            scan_stats.add('stat_calls', len(names))
+            start   = time.perf_counter() if scan_stats.timed else 0
+            subdirs = []
+            for name in names:
+                try:
+                    subdir_info = os.lstat(os.path.join(dirpath, name))
+                except OSError:
+                    continue
+                # anything that has been replaced by a file since is left out
+                if stat.S_ISDIR(subdir_info.st_mode) or stat.S_ISLNK(subdir_info.st_mode):
+                    subdirs.append((name, subdir_info))
+            if scan_stats.timed:
+                scan_stats.add('stat_time', time.perf_counter() - start)
+            return subdirs, files
+
+    return scan_dir(dirpath)
+
+
+
+def walk_tree(top, jobs=1, cached_listing=None, lazy=False, governor=None):
+    """ Walk a directory tree top-down in os.walk order and yield (dirpath, dir_info, dirnames, files) for each directory,
+        listed by jobs threads, or read one entry at a time with lazy=True
+    """
+
+    # serial walk that reads the directories lazily, dirnames is complete once files has been read
+    if lazy:
+        stack = [(top, None)]
+        while stack:
+            dirpath, dir_info = stack.pop()
+            try:
+                scandir_it = os.scandir(dirpath)
+            except OSError:
+                continue
+            subdirs  = []
+            dirnames = []
+            files    = iter_dir(scandir_it, subdirs, dirnames)
+            yield dirpath, dir_info if dir_info is not None else os.lstat(dirpath), dirnames, files
+            # make sure all subdirectories are found, even if the consumer did not read all files
+            for file in files:
+                pass
+            stack.extend((os.path.join(dirpath, name), info) for name, info in reversed(subdirs) if not stat.S_ISLNK(info.st_mode))
+        return
+
+    # serial walk
+    if jobs <= 1:
+        stack = [(top, None)]
+        while stack:
+            dirpath, dir_info = stack.pop()
+            listing = governed_list_dir(dirpath, dir_info, cached_listing, governor)
+            if listing is None:
+                continue
+            subdirs, files = listing
+            yield dirpath, dir_info if dir_info is not None else os.lstat(dirpath), [name for name, info in subdirs], files
+            stack.extend((os.path.join(dirpath, name), info) for name, info in reversed(subdirs) if not stat.S_ISLNK(info.st_mode))
+        return
+
+    # limit how many directory listings the workers may hold in memory ahead of the consumer
+    prefetch_limit = jobs * 64
+    in_flight      = [0]
+    lock           = threading.Lock()
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+
+        def scan(dirpath, dir_info):
+            listing = governed_list_dir(dirpath, dir_info, cached_listing, governor)
+            if listing is None:
+                return None
+            subdirs, files = listing
+
+            # start listing the subdirectories right away if there is room for it,
+            # otherwise the consumer will submit them once it gets to them
+            children = []
+            for name, subdir_info in subdirs:
+                if stat.S_ISLNK(subdir_info.st_mode):
+                    continue
+                child_path = os.path.join(dirpath, name)
+                with lock:
+                    prefetch = in_flight[0] < prefetch_limit
+                    if prefetch:
+                        in_flight[0] += 1
+                children.append((child_path, subdir_info, executor.submit(scan, child_path, subdir_info) if prefetch else None))
+            return [name for name, subdir_info in subdirs], files, children
+
+        in_flight[0] = 1
+        stack = [(top, None, executor.submit(scan, top, None))]
+        while stack:
+            dirpath, dir_info, future = stack.pop()
+            if future is None:
+                with lock:
+                    in_flight[0] += 1
+                future = executor.submit(scan, dirpath, dir_info)
+            result = future.result()
+            with lock:
+                in_flight[0] -= 1
+            if result is None:
+                continue
+            dirnames, files, children = result
+            yield dirpath, dir_info if dir_info is not None else os.lstat(dirpath), dirnames, files
+            stack.extend(reversed(children))
+
+
+
+class SortedList:
+    """ A list of records read back in list.sort(key=key, reverse=reverse) order, spilled to disk every max_records """
+
+    def __init__(self, max_records=None, tmp_dir=None, key=None, reverse=False, top_k=0):
+        self.records     = []
+        self.runs        = []
+        self.count       = 0
+        self.max_records = max_records
+        self.tmp_dir     = tmp_dir
+        self.key         = key
+        self.reverse     = reverse
+        self.top_k       = top_k
+        self.top         = []
+
+
+    def __len__(self):
+        return self.count
+
+
+    def append(self, record):
+        self.records.append(record)
+        self.count += 1
+
+        # a min-heap of the largest records, where the later of two equally large ones is dropped first
+        if len(self.top) < self.top_k:
+            heapq.heappush(self.top, (self.key(record) if self.key else record, -self.count, record))
+        elif self.top_k:
+            heapq.heappushpop(self.top, (self.key(record) if self.key else record, -self.count, record))
+
+        if self.max_records and len(self.records) >= self.max_records:
+            self.spill()
+
+
+    def spill(self):
+        """ Write the records held in memory to a temporary file as a sorted run """
+        self.records.sort(key=self.key, reverse=self.reverse)
+        run = tempfile.TemporaryFile(dir=self.tmp_dir)
+        for i in range(0, len(self.records), 10000):
+            pickle.dump(self.records[i:i + 10000], run, protocol=pickle.HIGHEST_PROTOCOL)
+        self.runs.append(run)
+        self.records = []
+
+
+    def read_run(self, run):
+        """ Yield the records of a spilled run """
+        run.seek(0)
+        while True:
+            try:
+                yield from pickle.load(run)
+            except EOFError:
+                break
+
+
+    def largest(self):
+        """ Return the top_k largest records, largest first """
+        return [record for key, order, record in sorted(self.top, reverse=True)]
+
+
+    def __iter__(self):
+        self.records.sort(key=self.key, reverse=self.reverse)
+        if not self.runs:
+            return iter(self.records)
+        # merge is stable, so equal records keep the order they were added in
+        return heapq.merge(*[self.read_run(run) for run in self.runs], iter(self.records), key=self.key, reverse=self.reverse)
+
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+
+
+
+def size_sorted_list(max_records=None, tmp_dir=None):
+    """ A SortedList of (path, size) tuples, largest first, that keeps the 10 largest for the on-screen report """
+    return SortedList(max_records, tmp_dir, key=lambda record: record[1], reverse=True, top_k=10)
+
+
+
+def summarize_dir(dirpath, files, classifier=default_classifier):
+    """ Count the files in a directory, pick out the 'uncompressed' ones and total them per category """
+    # put the files in categories by their extension
+    start        = time.perf_counter() if scan_stats.timed else 0
+    category     = classifier.category
+    categories   = {}
+    uncompressed = []
+    for file, file_info in files:
+        file_category = category(file)
+        totals = categories.get(file_category)
+        if totals is None:
+            totals = categories[file_category] = [0, 0]
+        totals[0] += 1
+        totals[1] += file_info.st_size
+        if file_category == 'uncompressed':
+            uncompressed.append((file, file_info.st_size))
+    if scan_stats.timed:
+        scan_stats.add('match_time', time.perf_counter() - start)
+
+    return len(files), uncompressed, categories
+
+
+
+# Files are put in age classes by how many days ago they were last modified or accessed, the last class is anything older
+AGE_CLASSES = [(7, '1 week'), (30, '1 month'), (90, '3 months'), (365, '1 year'), (3 * 365, '3 years')]
+AGE_LIMITS  = [days * 86400 * 10**9 for days, label in AGE_CLASSES]
+AGE_LABELS  = [label for days, label in AGE_CLASSES] + ['longer ago']
+# Files modified or accessed within this many days are hot, and sent first by gen --hot-first
+HOT_DAYS    = 30
+
+# The columns of a usage row: regular files, their size, the space allocated for them on disk, sparse files
+# and the bytes of holes in them, the size of the hot files, and the size per age class by mtime and by atime
+USAGE_FIELDS = ['files', 'bytes', 'allocated', 'sparse_files', 'sparse_holes', 'hot_bytes', 'mtime_bytes', 'atime_bytes']
+
+
+
+def new_usage():
+    """ An empty usage row, a list with the totals first and the two age histograms after them """
+    return [0] * (6 + 2 * len(AGE_LABELS))
+
+
+
+def account_usage(usage, files, now_ns, sparse_files=None):
+    """ Add the size, allocated size and age of the regular files to a usage row, and their sparse files to sparse_files """
+    start     = time.perf_counter() if scan_stats.timed else 0
+    n_ages    = len(AGE_LABELS)
+    hot_limit = now_ns - HOT_DAYS * 86400 * 10**9
+    for file, file_info in files:
+        if not stat.S_ISREG(file_info.st_mode):
+            continue
+        size      = file_info.st_size
+        allocated = file_info.st_blocks * 512
+        usage[0] += 1
+        usage[1] += size
+        usage[2] += allocated
+        # a file with less space allocated than its size has holes, which rsync writes out in full without --sparse
+        if allocated < size:
+            usage[3] += 1
+            usage[4] += size - allocated
+            if sparse_files is not None:
+                sparse_files.append((file, size - allocated))
+        if file_info.st_mtime_ns >= hot_limit or file_info.st_atime_ns >= hot_limit:
+            usage[5] += size
+        usage[6 + bisect.bisect(AGE_LIMITS, now_ns - file_info.st_mtime_ns)] += size
+        usage[6 + n_ages + bisect.bisect(AGE_LIMITS, now_ns - file_info.st_atime_ns)] += size
+    if scan_stats.timed:
+        scan_stats.add('match_time', time.perf_counter() - start)
+
+
+
+def format_usage(usage):
+    """ A usage row as the tab separated columns of a line in the usage file, with the histograms comma separated """
+    n_ages = len(AGE_LABELS)
+    return "\t".join(map(str, usage[:6])) + "\t" + ",".join(map(str, usage[6:6 + n_ages])) + "\t" + ",".join(map(str, usage[6 + n_ages:]))
+
+
+
+def read_usage(path):
+    """ Yield (rel_dir, usage row) for each directory in a usage file written by check --usage """
+    with gzip.open(path, 'rt') as usage_file:
+        for line in usage_file:
+            if line.startswith('#'):
+                continue
+            *fields, rel_dir = line.rstrip('\n').split('\t', 8)
+            usage = [int(field) for field in fields[:6]]
+            for histogram in fields[6:]:
+                usage.extend(int(size) for size in histogram.split(','))
+            yield rel_dir, usage
+
+
+
+# The parts of a file's lstat result that are kept in the scan index
+FileInfo = collections.namedtuple('FileInfo', ['st_mode', 'st_uid', 'st_gid', 'st_size', 'st_mtime_ns', 'st_dev', 'st_ino', 'st_nlink', 'st_blocks', 'st_atime_ns'])
+
+
+
+# A file in the scan index, the fields of FileInfo as fixed size binary numbers
+FILE_RECORD = struct.Struct('<IIIqqQQQqq')
+
+
+
+def encode_files(files):
+    """ Pack a list of (filename, file_info) tuples into a compressed blob """
+    records = b''.join(FILE_RECORD.pack(info.st_mode, info.st_uid, info.st_gid, info.st_size, info.st_mtime_ns, info.st_dev, info.st_ino, info.st_nlink, info.st_blocks, info.st_atime_ns) for name, info in files)
+    return zlib.compress(struct.pack('<I', len(files)) + records + os.fsencode('\0'.join(name for name, info in files)))
+
+
+
+def decode_files(blob):
+    """ Unpack a blob created by encode_files into a list of (filename, FileInfo) tuples """
+    data = zlib.decompress(blob)
+    n_files, = struct.unpack_from('<I', data)
+    end = 4 + n_files * FILE_RECORD.size
+    names = os.fsdecode(data[end:]).split('\0') if n_files else []
+    return list(zip(names, map(FileInfo._make, FILE_RECORD.iter_unpack(data[4:end]))))
+
+
+
+class ScanIndex:
+    """ Per-directory results of a previous check in SQLite, reused for directories whose mtime has not changed """
+
+    # bump when the table layout or the meaning of the stored data changes
+    VERSION = 6
+
+    # directories modified this close to the start of the previous scan may have been
+    # changed again within the same mtime tick, so they are always listed
+    RACY_NS = 2 * 10**9
+
+    def __init__(self, path, local_dir, rescan=False):
+        self.path        = path
+        self.tmp_path    = f"{path}.tmp"
+        self.lock        = threading.Lock()
+        self.reused      = 0
+        self.reused_rows = {}
+        self.old         = None
+        self.old_start   = 0
+
+        # open the previous index if it is usable for this directory
+        if not rescan and os.path.isfile(path):
+            try:
+                old = sqlite3.connect(path, check_same_thread=False)
+                meta = dict(old.execute("SELECT key, value FROM meta"))
+                if meta.get('version') == str(self.VERSION) and meta.get('local_dir') == local_dir:
+                    self.old       = old
+                    self.old_start = int(meta['started_ns'])
+                else:
+                    old.close()
+            except sqlite3.DatabaseError:
+                self.old = None
+
+        # start a new index
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+        self.new = sqlite3.connect(self.tmp_path)
+        self.new.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.new.execute("""CREATE TABLE dirs (
+                                path               BLOB PRIMARY KEY,
+                                mtime_ns           INTEGER,
+                                n_files            INTEGER,
+                                total_size         INTEGER,
+                                uncompressed_count INTEGER,
+                                uncompressed_size  INTEGER,
+                                subdirs            BLOB,
+                                files              BLOB)""")
+        self.new.executemany("INSERT INTO meta VALUES (?, ?)", [('version', str(self.VERSION)), ('local_dir', local_dir), ('started_ns', str(int(time.time() * 10**9)))])
+
+
+    def previous_totals(self):
+        """ Return the number of directories and files found by the previous run, or None if there is no usable index """
+        if self.old is None:
+            return None
+        with self.lock:
+            return self.old.execute("SELECT COUNT(*), TOTAL(n_files) FROM dirs").fetchone()
+
+
+    def cached_listing(self, dirpath, dir_info):
+        """ Return the (dirnames, files) of a directory that has not changed since the last run, otherwise None """
+        if self.old is None or dir_info.st_mtime_ns >= self.old_start - self.RACY_NS:
+            return None
+        with self.lock:
+            row = self.old.execute("SELECT mtime_ns, subdirs, files FROM dirs WHERE path = ?", (os.fsencode(dirpath),)).fetchone()
+            if row is None or row[0] != dir_info.st_mtime_ns:
+                return None
+            self.reused += 1
+        subdirs = zlib.decompress(row[1])
+        dirnames = [os.fsdecode(name) for name in subdirs.split(b'\0')] if subdirs else []
+        # kept until add() copies the stored blobs, which saves encoding the files again
+        self.reused_rows[dirpath] = (dirnames, row[1], row[2])
+        return dirnames, decode_files(row[2])
+
+
+    def add(self, dirpath, dir_info, dirnames, files, uncompressed):
+        """ Store the listing of a directory in the new index """
+        with self.lock:
+            reused = self.reused_rows.pop(dirpath, None)
+        if reused is not None and reused[0] == dirnames:
+            subdirs_blob, files_blob = reused[1:]
+        else:
+            subdirs_blob, files_blob = zlib.compress(b'\0'.join(os.fsencode(name) for name in dirnames)), encode_files(files)
+        self.new.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         (os.fsencode(dirpath),
+                          dir_info.st_mtime_ns,
+                          len(files),
+                          sum(info.st_size for name, info in files),
+                          len(uncompressed),
+                          sum(size for file, size in uncompressed),
+                          subdirs_blob,
+                          files_blob))
+
+
+    def close(self, save=True):
+        """ Replace the old index with the new one, or throw the new one away """
+        if self.old is not None:
+            self.old.close()
+        if save:
+            self.new.commit()
+        self.new.close()
+        if save:
+            os.replace(self.tmp_path, self.path)
+        else:
+            os.remove(self.tmp_path)
+
+
+
+def read_index(path, local_dir):
+    """ Yield (dirpath, dirnames, files) for each directory in a scan index written by check, in walk order """
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"scan index not found, {path}")
+    index = sqlite3.connect(path)
+    try:
+        meta = dict(index.execute("SELECT key, value FROM meta"))
+        if meta.get('version') != str(ScanIndex.VERSION):
+            raise ValueError(f"scan index {path} was created by another version of darsync, run the check again")
+        if meta.get('local_dir') != local_dir:
+            raise ValueError(f"scan index {path} was created for {meta.get('local_dir')}, not {local_dir}")
+        for dirpath, subdirs, files in index.execute("SELECT path, subdirs, files FROM dirs ORDER BY rowid"):
+            subdirs = zlib.decompress(subdirs)
+            yield os.fsdecode(dirpath), [os.fsdecode(name) for name in subdirs.split(b'\0')] if subdirs else [], decode_files(files)
+    finally:
+        index.close()
+
+
+
+def read_scan_totals(index_path):
+    """ Return the number of directories, files and bytes found by check from its index, or None if there is no index """
+    if not os.path.isfile(index_path):
+        return None
+    try:
+        db = sqlite3.connect(index_path)
+        try:
+            n_dirs, n_files, n_bytes = db.execute("SELECT COUNT(*), TOTAL(n_files), TOTAL(total_size) FROM dirs").fetchone()
+            return n_dirs, int(n_files), int(n_bytes)
+        finally:
+            db.close()
+    except sqlite3.DatabaseError:
+        return None
+
+
+
+def in_dirs(path, dirs):
+    """ Whether a relative path is one of the relative directories in the set dirs, or inside one of them """
+    while path:
+        if path in dirs:
+            return True
+        path = os.path.dirname(path)
+    return False
+
+
+
+def plan_partitions(index_path, local_dir, n_partitions, list_prefix, exclude_dirs=()):
+    """ Split the files in a scan index into n_partitions balanced rsync --files-from lists and return their (n_files, n_bytes) """
+
+    # get the totals to balance against
+    if not os.path.isfile(index_path):
+        raise FileNotFoundError(f"scan index not found, {index_path}")
+    index = sqlite3.connect(index_path)
+    total_files, total_bytes = index.execute("SELECT COALESCE(SUM(n_files), 0), COALESCE(SUM(total_size), 0) FROM dirs").fetchone()
+    total_files = max(total_files, 1)
+    total_bytes = max(total_bytes, 1)
+
+    large_limit = total_bytes / (n_partitions * 16)
+    chunk_bytes = total_bytes / (n_partitions * 64)
+    chunk_files = 1000
+
+    partitions = [[0, 0] for i in range(n_partitions)]
+    heap       = [(0.0, i) for i in range(n_partitions)]
+    lists      = [open(f"{list_prefix}.{i}", 'wb') for i in range(n_partitions)]
+
+    def relative(dirpath):
+        return '' if dirpath == local_dir else os.path.relpath(dirpath, local_dir)
+
+    def place(paths, n_files, n_bytes):
+        """ Add a unit of paths to the least loaded partition """
+        load, i = heapq.heappop(heap)
+        lists[i].write(b''.join(os.fsencode(path) + b'\0' for path in paths))
+        partitions[i][0] += n_files
+        partitions[i][1] += n_bytes
+        heapq.heappush(heap, (partitions[i][0] / total_files + partitions[i][1] / total_bytes, i))
+
+    try:
+        # place the large files first, largest first
+        large_files = []
+        for dirpath, dirnames, files in read_index(index_path, local_dir):
+            rel_dir = relative(dirpath)
+            if in_dirs(rel_dir, exclude_dirs):
+                continue
+            large_files.extend((info.st_size, os.path.join(rel_dir, name)) for name, info in files if info.st_size > large_limit)
+        large_files.sort(reverse=True)
+        for size, path in large_files:
+            place([path], 1, size)
+        del large_files
+
+        # place the rest in chunks, the directory itself and any subdirectories that were not
+        # walked into (symlinks and unreadable directories) go with its first chunk
+        for dirpath, dirnames, files in read_index(index_path, local_dir):
+            rel_dir = relative(dirpath)
+            if in_dirs(rel_dir, exclude_dirs):
+                continue
+            paths   = [rel_dir] if rel_dir else []
+            paths.extend(os.path.join(rel_dir, name) for name in dirnames if index.execute("SELECT 1 FROM dirs WHERE path = ?", (os.fsencode(os.path.join(dirpath, name)),)).fetchone() is None)
+            n_files = 0
+            n_bytes = 0
+            for name, info in files:
+                if info.st_size > large_limit:
+                    continue
+                paths.append(os.path.join(rel_dir, name))
+                n_files += 1
+                n_bytes += info.st_size
+                if n_files >= chunk_files or n_bytes >= chunk_bytes:
+                    place(paths, n_files, n_bytes)
+                    paths, n_files, n_bytes = [], 0, 0
+            if paths:
+                place(paths, n_files, n_bytes)
+    finally:
+        index.close()
+        for file_list in lists:
+            file_list.close()
+
+    return [tuple(partition) for partition in partitions]
+
+
+
+def read_nul_separated(f, block_size=1024 ** 2):
+    """ Yield the NUL terminated records of a binary file, reading it in blocks """
+    buffer = b''
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        *records, buffer = (buffer + block).split(b'\0')
+        yield from records
+
+
+
+def read_file_list(list_path, exclude_dirs=()):
+    """ Yield the entries of a gzipped NUL separated file list, leaving out the ones in exclude_dirs """
+    with gzip.open(list_path, 'rb') as file_list:
+        for entry in read_nul_separated(file_list):
+            if not exclude_dirs or not in_dirs(entry, exclude_dirs):
+                yield entry
+
+
+
+def split_file_list(list_path, chunk_prefix, chunk_files, write=True, exclude_dirs=()):
+    """ Split a gzipped NUL separated file list into gzipped chunks of chunk_files entries and return the number of chunks """
+    n_chunks = 0
+    n_lines  = 0
+    chunk    = None
+    for entry in read_file_list(list_path, exclude_dirs):
+        if n_chunks == 0 or n_lines >= chunk_files:
+            if chunk:
+                chunk.close()
+            if write:
+                chunk = gzip.open(f"{chunk_prefix}.{n_chunks}.gz", 'wb')
+            n_chunks += 1
+            n_lines  = 0
+        if chunk:
+            chunk.write(entry + b'\0')
+        n_lines += 1
+    if chunk:
+        chunk.close()
+    return n_chunks
+
+
+
+def order_file_list(list_path, usage_path, ordered_path, tmp_dir=None, exclude_dirs=()):
+    """ Write a file list grouped by directory, the ones with the most hot bytes first, sorted on disk """
+    directories = sorted(((usage[5], usage[1], rel_dir) for rel_dir, usage in read_usage(usage_path)), key=lambda x: x[:2], reverse=True)
+    ranks       = {os.fsencode(rel_dir): rank for rank, (hot_bytes, n_bytes, rel_dir) in enumerate(directories)}
+    ordered     = SortedList(1000000, tmp_dir)
+    try:
+        for n, entry in enumerate(read_file_list(list_path, exclude_dirs)):
+            # directories without regular files have no usage, the entries in them are sent last
+            ordered.append((ranks.get(os.path.dirname(entry), len(ranks)), n, entry))
+        with gzip.open(ordered_path, 'wb') as ordered_list:
+            for rank, n, entry in ordered:
+                ordered_list.write(entry + b'\0')
+    finally:
+        ordered.close()
+
+
+
+def read_crowded_dirs(path):
+    """ Yield (n_files, dirpath) from a prefix.dir_n_files report written by check """
+    with open(path) as report:
+        for line in report:
+            n_files, dirpath = line.rstrip('\n').split(' ', 1)
+            yield int(n_files), dirpath
+
+
+
+def plan_packing(crowded_dirs, local_dir, index_path, pack_dir=None):
+    """ Turn crowded directories into tar archive units of (rel_dir, n_files, n_bytes), and write their plan to pack_dir """
+    units = []
+    for dirpath in sorted(crowded_dirs):
+        rel_dir = os.path.relpath(dirpath, local_dir)
+        # the whole tree can not be packed, and anything outside it is not transferred
+        if rel_dir == '.' or rel_dir.startswith('..'):
+            continue
+        if any(rel_dir.startswith(unit + '/') for unit in units):
+            continue
+        units.append(rel_dir)
+
+    # count the files and bytes in each unit, including subdirectories
+    index = sqlite3.connect(index_path) if os.path.isfile(index_path) else None
+    plan = []
+    for rel_dir in units:
+        n_files, n_bytes = 0, 0
+        if index:
+            path = os.fsencode(os.path.join(local_dir, rel_dir))
+            try:
+                n_files, n_bytes = index.execute("SELECT COALESCE(SUM(n_files), 0), COALESCE(SUM(total_size), 0) FROM dirs WHERE path = ? OR (path >= ? AND path < ?)", (path, path + b'/', path + b'0')).fetchone()
+            except sqlite3.DatabaseError:
+                pass
+        plan.append((rel_dir, n_files, n_bytes))
+    if index:
+        index.close()
+
+    if pack_dir is not None:
+        os.makedirs(pack_dir, exist_ok=True)
+        with open(f"{pack_dir}/plan", 'w') as plan_file:
+            plan_file.write("index\tfiles\tbytes\tdirectory\n")
+            for i, (rel_dir, n_files, n_bytes) in enumerate(plan):
+                plan_file.write(f"{pack_dir}/{i}.index\t{n_files}\t{n_bytes}\t{rel_dir}\n")
+        with open(f"{pack_dir}/exclude", 'w') as exclude_file:
+            for rel_dir in units:
+                # backslashes only escape wildcards in patterns that contain wildcards
+                if any(c in rel_dir for c in '*?['):
+                    rel_dir = ''.join('\\' + c if c in '*?[\\' else c for c in rel_dir)
+                exclude_file.write(f"/{rel_dir}/\n")
+        with open(f"{pack_dir}/dirs", 'wb') as dirs_file:
+            dirs_file.write(b''.join(os.fsencode(rel_dir) + b'\0' for rel_dir in units))
+
+    return plan
+
+
+
+# Checksum manifests are written in chunks of this size, so large files are hashed in parallel
+MANIFEST_CHUNK_SIZE = 64 * 1024 ** 2 # 64MB
+# manifests without hashes have the digest '-' and the hash 'none' with chunk size 0 in the header
+MANIFEST_HEADER     = b"darsync-manifest 2 %s %d"
+MANIFEST_NO_DIGEST  = b'-'
+
+
+
+def walk_sorted(top, exclude_dirs=()):
+    """ Yield (relpath, lstat result) of the files and symlinks under top, with relpath as bytes, sorted by path components """
+    # a stack of (relative dir path, entries left to visit in reverse order)
+    stack = [(b'', None)]
+    while stack:
+        reldir, entries = stack[-1]
+        if entries is None:
+            try:
+                with os.scandir(os.path.join(os.fsencode(top), reldir) if reldir else os.fsencode(top)) as scandir_it:
+                    entries = sorted(scandir_it, key=lambda entry: entry.name, reverse=True)
+            except OSError:
+                entries = []
+            stack[-1] = (reldir, entries)
+        if not entries:
+            stack.pop()
+            continue
+        entry   = entries.pop()
+        relpath = os.path.join(reldir, entry.name) if reldir else entry.name
+        try:
+            info = entry.stat(follow_symlinks=False)
+        except OSError:
+            continue
+        if stat.S_ISDIR(info.st_mode):
+            if relpath not in exclude_dirs:
+                stack.append((relpath, None))
+        elif stat.S_ISREG(info.st_mode) or stat.S_ISLNK(info.st_mode):
+            yield relpath, info
+
+
+
+def hash_chunk(path, offset, length):
+    """ Return the digest of length bytes of a file starting at offset """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb', buffering=0) as f:
+        f.seek(offset)
+        while length > 0:
+            block = f.read(min(length, 1024 ** 2))
+            if not block:
+                break
+            digest.update(block)
+            length -= len(block)
+    return digest.digest()
+
+
+
+def write_manifest(top, outfile, jobs=4, chunk_size=MANIFEST_CHUNK_SIZE, exclude_dirs=(), entries=None, hash_files=True):
+    """ Write a gzipped manifest of the files under top, or of the given entries, and return the number of files and bytes hashed """
+    n_files = 0
+    n_bytes = 0
+    top_bytes = os.fsencode(top)
+    if entries is None:
+        entries = walk_sorted(top, exclude_dirs)
+
+    with gzip.open(outfile, 'wb') if isinstance(outfile, str) else gzip.GzipFile(fileobj=outfile, mode='wb') as manifest, ThreadPoolExecutor(max_workers=jobs) as executor:
+        manifest.write((MANIFEST_HEADER % (b'blake2b-128', chunk_size) if hash_files else MANIFEST_HEADER % (b'none', 0)) + b'\0')
+
+        # (relpath, size, mtime_ns, futures or digest) in manifest order
+        pending   = deque()
+        n_pending = 0
+
+        def write_oldest():
+            relpath, size, mtime_ns, chunks = pending.popleft()
+            if isinstance(chunks, str):
+                digest = chunks
+            else:
+                file_digest = hashlib.blake2b(b"%d" % size, digest_size=16)
+                try:
+                    for chunk in chunks:
+                        file_digest.update(chunk.result())
+                    digest = file_digest.hexdigest()
+                except OSError as e:
+                    # never matches, so the file is sent again and rsync reports the problem
+                    digest = f"error:{e.errno}"
+            manifest.write(b"%s\t%d\t%d\t%s\0" % (digest.encode(), size, mtime_ns, relpath))
+            return 0 if isinstance(chunks, str) else len(chunks)
+
+        for relpath, info in entries:
+            path = os.path.join(top_bytes, relpath)
+            if not hash_files:
+                pending.append((relpath, info.st_size, info.st_mtime_ns, MANIFEST_NO_DIGEST.decode()))
+                if not stat.S_ISLNK(info.st_mode):
+                    n_files += 1
+                    n_bytes += info.st_size
+            elif stat.S_ISLNK(info.st_mode):
+                try:
+                    target = os.readlink(path)
+                except OSError:
+                    continue
+                pending.append((relpath, len(target), info.st_mtime_ns, 'link:' + hashlib.blake2b(target, digest_size=16).hexdigest()))
+            else:
+                chunks = [executor.submit(hash_chunk, path, offset, chunk_size) for offset in range(0, max(info.st_size, 1), chunk_size)]
+                pending.append((relpath, info.st_size, info.st_mtime_ns, chunks))
+                n_pending += len(chunks)
+                n_files   += 1
+                n_bytes   += info.st_size
+
+            # keep a bounded number of chunks in flight
+            while n_pending > jobs * 4:
+                n_pending -= write_oldest()
+
+        while pending:
+            write_oldest()
+
+    return n_files, n_bytes
+
+
+
+def read_manifest(path):
+    """ Return the chunk size of a manifest, 0 without hashes, and a generator of its (relpath, size, digest, mtime_ns) records """
+    manifest = gzip.open(path, 'rb')
+
+    def records(version):
+        with manifest:
+            for line in read_nul_separated(manifest):
+                if version == b'1':
+                    digest, size, relpath = line.split(b'\t', 2)
+                    yield relpath, int(size), digest, None
+                else:
+                    digest, size, mtime_ns, relpath = line.split(b'\t', 3)
+                    yield relpath, int(size), digest, int(mtime_ns)
+
+    header = b''
+    while not header.endswith(b'\0'):
+        byte = manifest.read(1)
+        if not byte:
+            break
+        header += byte
+    fields = header.rstrip(b'\0').split(b' ')
+    if len(fields) != 4 or fields[0] != b'darsync-manifest' or fields[1] not in (b'1', b'2'):
+        manifest.close()
+        raise ValueError(f"not a darsync manifest, {path}")
+
+    return int(fields[3]), records(fields[1])
+
+
+
+def compare_manifests(local_records, remote_records):
+    """ Merge two manifests and yield the relative paths of files that are missing or different in the remote one """
+    def key(relpath):
+        return relpath.split(b'/')
+
+    remote = next(remote_records, None)
+    for relpath, size, digest, mtime_ns in local_records:
+        local_key = key(relpath)
+        # skip files that only exist on the remote side
+        while remote is not None and key(remote[0]) < local_key:
+            remote = next(remote_records, None)
+        if remote is None or remote[0] != relpath or remote[1] != size or remote[2] != digest or digest.startswith(b'error:'):
+            yield relpath
+
+
+
+def diff_manifests(local_records, remote_records, modify_window=1):
+    """ Merge a local and a remote manifest and yield (status, relpath, size) for the files that differ """
+    local  = next(local_records, None)
+    remote = next(remote_records, None)
+    window = modify_window * 10**9
+    while local is not None or remote is not None:
+        # the same key as walk_sorted orders the paths by, as '/' sorts before every other byte in a name
+        local_key  = local[0].replace(b'/', b'\0') if local is not None else None
+        remote_key = remote[0].replace(b'/', b'\0') if remote is not None else None
+        if remote is None or (local is not None and local_key < remote_key):
+            yield 'new', local[0], local[1]
+            local = next(local_records, None)
+        elif local is None or remote_key < local_key:
+            yield 'deleted', remote[0], remote[1]
+            remote = next(remote_records, None)
+        else:
+            relpath, size, digest, mtime_ns = local
+            if MANIFEST_NO_DIGEST not in (digest, remote[2]):
+                changed = digest != remote[2] or digest.startswith(b'error:')
+            else:
+                changed = size != remote[1] or mtime_ns is None or remote[3] is None or abs(mtime_ns - remote[3]) >= window
+            if changed:
+                yield 'changed', relpath, size
+            local  = next(local_records, None)
+            remote = next(remote_records, None)
+
+
+
+# The parts of a file's lstat result that write_manifest needs
+ManifestEntry = collections.namedtuple('ManifestEntry', ['st_mode', 'st_size', 'st_mtime_ns'])
+
+
+
+# Files of the same size are first compared by a hash of this many bytes from their start
+DEDUP_PARTIAL_SIZE = 64 * 1024 # 64KB
+
+
+
+def find_duplicates(size_buckets, jobs=4, partial_size=DEDUP_PARTIAL_SIZE, chunk_size=MANIFEST_CHUNK_SIZE):
+    """ Find files with identical content among the (size, paths) buckets and return (size, paths) groups, most reclaimable first """
+    duplicates = []
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+
+        # (size, [(path, future)]) of buckets waiting for their partial hashes, and
+        # (size, [(path, [chunk futures])]) of groups waiting for their full hashes
+        partial   = deque()
+        full      = deque()
+        n_pending = 0
+
+        def group(items, digest):
+            groups = collections.defaultdict(list)
+            for path, futures in items:
+                try:
+                    groups[digest(futures)].append(path)
+                except OSError:
+                    # files that can not be read are not reported as duplicates
+                    continue
+            return [paths for paths in groups.values() if len(paths) > 1]
+
+        def full_digest(chunks):
+            file_digest = hashlib.blake2b(digest_size=16)
+            for chunk in chunks:
+                file_digest.update(chunk.result())
+            return file_digest.digest()
+
+        def finish_oldest():
+            # finish the oldest full hashes first, so there are never more than a few groups in flight
+            nonlocal n_pending
+            if full:
+                size, items = full.popleft()
+                duplicates.extend((size, paths) for paths in group(items, full_digest))
+                n_pending -= sum(len(chunks) for path, chunks in items)
+                return
+            size, items = partial.popleft()
+            n_pending -= len(items)
+            for paths in group(items, lambda future: future.result()):
+                if size <= partial_size:
+                    # the partial hash already covers the whole file
+                    duplicates.append((size, paths))
+                else:
+                    chunks = [[executor.submit(hash_chunk, path, offset, chunk_size) for offset in range(0, size, chunk_size)] for path in paths]
+                    full.append((size, list(zip(paths, chunks))))
+                    n_pending += sum(map(len, chunks))
+
+        for size, paths in size_buckets:
+            if len(paths) < 2:
+                continue
+            partial.append((size, [(path, executor.submit(hash_chunk, path, 0, partial_size)) for path in paths]))
+            n_pending += len(paths)
+            while n_pending > jobs * 4:
+                finish_oldest()
+
+        while partial or full:
+            finish_oldest()
+
+    return sorted(duplicates, key=lambda duplicate: duplicate[0] * (len(duplicate[1]) - 1), reverse=True)
+
+
+
+# A line of rsync --info=progress2 output: bytes sent, percent done, rate, time left and,
+# once a file has been sent, (xfr#files sent, to-chk=files left to check/files in the list)
+RSYNC_PROGRESS = re.compile(rb"^\s*([\d,]+)\s+(\d+)%\s+([\d.]+)([kMGT]?B)/s\s+\S+(?:\s+\(xfr#(\d+), \w+-chk=(\d+)/(\d+)\))?")
+RATE_UNITS     = {b'B': 1, b'kB': 1024, b'MB': 1024 ** 2, b'GB': 1024 ** 3, b'TB': 1024 ** 4}
+
+
+
+def parse_rsync_progress(line):
+    """ Return the fields of a line of rsync --info=progress2 output as a dict, or None if it is not one """
+    match = RSYNC_PROGRESS.match(line)
+    if not match:
+        return None
+    sent, percent, rate, unit, files, to_check, total = match.groups()
+    progress = {'bytes': int(sent.replace(b',', b'')), 'percent': int(percent), 'rate': float(rate) * RATE_UNITS[unit]}
+    if files:
+        progress.update(files=int(files), to_check=int(to_check), listed=int(total))
+    return progress
+
+
+
+def read_progress(path):
+    """ Summarize a progress file written by record-progress, from the last snapshot of every run """
+    runs = {}
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line may be half written
+                continue
+            runs[record['run']] = record
+
+    # the state of a unit is decided by its latest run, a run that has not reported for a while was stopped
+    units = collections.defaultdict(lambda: {'bytes': 0, 'files': 0, 'rate': 0, 'state': None, 'time': 0})
+    now   = time.time()
+    for record in sorted(runs.values(), key=lambda record: record['time']):
+        unit = units[record['unit']]
+        unit['bytes'] += record['bytes']
+        unit['files'] += record['files']
+        unit['time']   = record['time']
+        if record.get('exit') is not None:
+            # killed by a signal, e.g. stopped before the time limit to be requeued
+            unit['state'], unit['rate'] = ('done' if record['exit'] == 0 else 'stopped' if record['exit'] < 0 else 'failed'), 0
+        elif now - record['time'] < 2 * record['interval'] + 60:
+            unit['state'], unit['rate'] = 'running', record['rate']
+        else:
+            unit['state'], unit['rate'] = 'stopped', 0
+
+    summary = {'bytes': sum(unit['bytes'] for unit in units.values()), 'files': sum(unit['files'] for unit in units.values()),
+               'rate': sum(unit['rate'] for unit in units.values()), 'updated': max((unit['time'] for unit in units.values()), default=0),
+               'units': dict(units)}
+    for state in ('running', 'stopped', 'done', 'failed'):
+        summary[state] = sum(1 for unit in units.values() if unit['state'] == state)
+    return summary
+
+
+
+# BGZF (bgzip) blocks hold at most this much uncompressed data, and end with an empty block
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF        = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+# Large files are compressed in segments of this size in parallel when using BGZF
+COMPRESS_SEGMENT_SIZE = 64 * 1024 ** 2 # 64MB
+
+
+
+def read_uncompressed_report(path):
+    """ Yield the file paths listed in a prefix.uncompressed report written by check """
+    with open(path) as report:
+        for line in report:
+            # lines look like "1.5 GB /path/to/file"
+            fields = line.rstrip('\n').split(' ', 2)
+            if len(fields) == 3:
+                yield fields[2]
+
+
+
+def bgzf_block(data, level):
+    """ Returns a single BGZF block containing data """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    # store incompressible data as is, so the block is guaranteed to fit in 64KB
+    if len(cdata) > 65536 - 26:
+        compressor = zlib.compressobj(0, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25)
+    return header + cdata + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+
+
+def compress_bgzf_segment(path, offset, length, level):
+    """ Returns length bytes of a file starting at offset compressed as BGZF blocks """
+    blocks = []
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while length > 0:
+            data = f.read(min(length, BGZF_BLOCK_SIZE))
+            if not data:
+                break
+            blocks.append(bgzf_block(data, level))
+            length -= len(data)
+    return b''.join(blocks)
+
+
+
+def verify_compressed(path, compressed_path):
+    """ Returns True if compressed_path decompresses to exactly the content of path """
+    with open(path, 'rb') as original, gzip.open(compressed_path, 'rb') as compressed:
+        while True:
+            block = original.read(1024 ** 2)
+            if block != compressed.read(len(block) or 1):
+                return False
+            if not block:
+                return True
+
+
+
+def compress_file(path, tmp_path, format, level):
+    """ Compress a whole file to tmp_path as gzip or BGZF and verify the result """
+    info = os.stat(path)
+    if format == 'bgzf':
+        with open(tmp_path, 'wb') as out:
+            for offset in range(0, info.st_size, COMPRESS_SEGMENT_SIZE):
+                out.write(compress_bgzf_segment(path, offset, COMPRESS_SEGMENT_SIZE, level))
+            out.write(BGZF_EOF)
+    else:
+        # a standard gzip header with the original name and modification time, like gzip does
+        with open(path, 'rb') as src, open(tmp_path, 'wb') as out, gzip.GzipFile(filename=os.path.basename(path), mode='wb', fileobj=out, compresslevel=level, mtime=int(info.st_mtime)) as gz:
+            shutil.copyfileobj(src, gz, 1024 ** 2)
+    return verify_compressed(path, tmp_path)
+
+
+
+# Binary ownership files start with this, followed by records of a flags byte, the length of the path or name,
+# the st_mode, uid and gid that differ from the previous record as flagged, and the path or name
+OWNERSHIP_MAGIC  = b"darsync-ownership 2\n"
+OWNERSHIP_HEADER = struct.Struct('<BH')
+OWNERSHIP_FILE, OWNERSHIP_DIR, OWNERSHIP_CONTINUE = 0, 1, 2 # the lowest two bits of the flags
+OWNERSHIP_MODE, OWNERSHIP_UID, OWNERSHIP_GID      = 4, 8, 16
+
+
+
+def ownership_file_path(local_dir, prefix, ownership_format='text'):
+    """ The path of the ownership file check writes in the folder to be transferred """
+    extension = 'ownership.bin.gz' if ownership_format == 'binary' else 'ownership.gz'
+    return f"{local_dir}/{os.path.basename(prefix)}.{extension}"
+
+
+
+class BGZFWriter:
+    """ Writes a BGZF file, independent gzip blocks compressed by a pool of threads and written in order """
+
+    def __init__(self, path, level=6, jobs=2):
+        self.file        = open(path, 'wb')
+        self.level       = level
+        self.executor    = ThreadPoolExecutor(max_workers=jobs)
+        self.pending     = deque()
+        self.max_pending = jobs * 4
+
+
+    def write_block(self, data):
+        """ Compress data, at most BGZF_BLOCK_SIZE bytes, as a block of its own """
+        self.pending.append(self.executor.submit(bgzf_block, bytes(data), self.level))
+        while self.pending and (len(self.pending) > self.max_pending or self.pending[0].done()):
+            self.file.write(self.pending.popleft().result())
+
+
+    def close(self):
+        while self.pending:
+            self.file.write(self.pending.popleft().result())
+        self.file.write(BGZF_EOF)
+        self.file.close()
+        self.executor.shutdown()
+
+
+
+class OwnershipWriter:
+    """ Writes the ownership file of a check as text lines or compact binary records, compressed in the background """
+
+    def __init__(self, path, local_dir, binary=False, jobs=2):
+        self.writer    = BGZFWriter(path, jobs=jobs)
+        self.local_dir = local_dir
+        self.binary    = binary
+        self.buffer    = bytearray(OWNERSHIP_MAGIC if binary else b'')
+        self.current   = b''
+        self.last      = None
+
+
+    def add_dir(self, dirpath, dir_info):
+        if not self.binary:
+            self.write(f"{stat.S_IMODE(dir_info.st_mode)}\t{dir_info.st_uid}\t{dir_info.st_gid}\t{dirpath}/\n".encode('utf-8', "surrogateescape"))
+            return
+        self.current = os.fsencode(os.path.relpath(dirpath, self.local_dir)) if dirpath != self.local_dir else b''
+        self.add_record(OWNERSHIP_DIR, dir_info, self.current)
+
+
+    def add_files(self, dirpath, files):
+        if not self.binary:
+            self.write("".join(f"{stat.S_IMODE(file_info.st_mode)}\t{file_info.st_uid}\t{file_info.st_gid}\t{os.path.join(dirpath, file)}\n" for file, file_info in files).encode('utf-8', "surrogateescape"))
+            return
+        for file, file_info in files:
+            self.add_record(OWNERSHIP_FILE, file_info, os.fsencode(file))
+
+
+    def add_record(self, record_type, info, path):
+        # the longest a record can be, if it has to start a new block
+        if len(self.buffer) + OWNERSHIP_HEADER.size * 2 + 12 + len(self.current) + len(path) > BGZF_BLOCK_SIZE:
+            self.writer.write_block(self.buffer)
+            self.buffer = bytearray()
+            self.last   = None
+            if record_type == OWNERSHIP_FILE:
+                self.buffer += OWNERSHIP_HEADER.pack(OWNERSHIP_CONTINUE, len(self.current)) + self.current
+
+        flags  = record_type
+        fields = b''
+        last   = self.last or (None, None, None)
+        if info.st_mode != last[0]:
+            flags  |= OWNERSHIP_MODE
+            fields += struct.pack('<I', info.st_mode)
+        if info.st_uid != last[1]:
+            flags  |= OWNERSHIP_UID
+            fields += struct.pack('<I', info.st_uid)
+        if info.st_gid != last[2]:
+            flags  |= OWNERSHIP_GID
+            fields += struct.pack('<I', info.st_gid)
+        self.last = info.st_mode, info.st_uid, info.st_gid
+        self.buffer += OWNERSHIP_HEADER.pack(flags, len(path)) + fields + path
+
+
+    def write(self, data):
+        """ Add text, lines may be split between blocks as the text is read as a stream anyway """
+        self.buffer += data
+        if len(self.buffer) >= BGZF_BLOCK_SIZE:
+            view = memoryview(self.buffer)
+            full = len(self.buffer) - len(self.buffer) % BGZF_BLOCK_SIZE
+            for offset in range(0, full, BGZF_BLOCK_SIZE):
+                self.writer.write_block(view[offset:offset + BGZF_BLOCK_SIZE])
+            view.release()
+            del self.buffer[:full]
+
+
+    def close(self):
+        if self.buffer:
+            self.writer.write_block(self.buffer)
+        self.writer.close()
+
+
+
+def read_ownership(path):
+    """ Yield (relpath, permission bits, st_mode, uid, gid, is_dir) for the entries in an ownership file of either format """
+    with gzip.open(path, 'rb') as f:
+
+        # text, the first line is the checked directory itself
+        if f.read(len(OWNERSHIP_MAGIC)) != OWNERSHIP_MAGIC:
+            f.seek(0)
+            root = None
+            for line in f:
+                mode, uid, gid, entry_path = line.rstrip(b'\n').split(b'\t', 3)
+                if root is None:
+                    root = entry_path
+                is_dir = entry_path.endswith(b'/')
+                yield entry_path[len(root):].rstrip(b'/'), int(mode), None, int(uid), int(gid), is_dir
+            return
+
+        buffer  = b''
+        offset  = 0
+        current = b''
+        last    = [0, 0, 0]
+        eof     = False
+        while True:
+            # keep at least one whole record in the buffer
+            if not eof and len(buffer) - offset < BGZF_BLOCK_SIZE:
+                block  = f.read(1024 ** 2)
+                eof    = not block
+                buffer = buffer[offset:] + block
+                offset = 0
+            if offset >= len(buffer):
+                return
+            flags, length = OWNERSHIP_HEADER.unpack_from(buffer, offset)
+            offset += OWNERSHIP_HEADER.size
+            for flag, field in ((OWNERSHIP_MODE, 0), (OWNERSHIP_UID, 1), (OWNERSHIP_GID, 2)):
+                if flags & flag:
+                    last[field] = struct.unpack_from('<I', buffer, offset)[0]
+                    offset += 4
+            st_mode, uid, gid = last
+            name    = buffer[offset:offset + length]
+            offset += length
+            record_type = flags & 3
+            if record_type == OWNERSHIP_FILE:
+                yield os.path.join(current, name) if current else name, stat.S_IMODE(st_mode), st_mode, uid, gid, False
+            elif record_type == OWNERSHIP_DIR:
+                current = name
+                yield name, stat.S_IMODE(st_mode), st_mode, uid, gid, True
+            else:
+                current = name
+
+
+
+BENCH_PARAMS_FILE = ".darsync-bench.json"
+
+
+
+def parse_extension_mix(text):
+    """ Parse an extension mix like 'fastq:3,fastq.gz:2,bam:1' into (extensions, weights) """
+    extensions = []
+    weights    = []
+    for item in text.split(','):
+        ext, _, weight = item.partition(':')
+        extensions.append('.' + ext.strip().lstrip('.'))
+        weights.append(float(weight or 1))
+    return extensions, weights
+
+
+
+def generate_tree(root, depth=4, fanout=4, files_per_dir=50, distribution='exponential', extensions="txt:1", mean_file_size=4096, crowded_dirs=0, crowded_files=100000, seed=0):
+    """ Create a reproducible synthetic tree of sparse files for benchmarks and return its directory and file counts and size """
+    rng = random.Random(seed)
+    ext_names, ext_weights = parse_extension_mix(extensions)
+    draw_count = {'fixed':       lambda: files_per_dir,
+                  'uniform':     lambda: rng.randint(0, 2 * files_per_dir),
+                  'exponential': lambda: int(rng.expovariate(1 / files_per_dir)) if files_per_dir else 0,
+                 }[distribution]
+
+    # create the directories breadth first, so the layout only depends on the parameters
+    dirs  = [root]
+    level = [root]
+    for _ in range(depth):
+        level = [os.path.join(parent, f"d{i}") for parent in level for i in range(fanout)]
+        dirs.extend(level)
+    for dirpath in dirs:
+        os.makedirs(dirpath, exist_ok=True)
+
+    file_counts = [draw_count() for _ in dirs]
+    for i in rng.sample(range(len(dirs)), min(crowded_dirs, len(dirs))):
+        file_counts[i] += crowded_files
+
+    n_files    = 0
+    total_size = 0
+    for dirpath, count in zip(dirs, file_counts):
+        for i, ext in enumerate(rng.choices(ext_names, ext_weights, k=count)):
+            size = int(rng.expovariate(1 / mean_file_size)) if mean_file_size else 0
+            with open(os.path.join(dirpath, f"f{i}{ext}"), 'wb') as f:
+                f.truncate(size)
+            total_size += size
+        n_files += count
+
+    return len(dirs), n_files, total_size
+
+
+
+def parse_size_mix(text):
+    """ Parse a file size mix like '64M:8,1M:64,4K:256' into a list of (size in bytes, number of files) """
+    units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    mix = []
+    for item in text.split(','):
+        size, _, count = item.partition(':')
+        size = size.strip().upper().rstrip('B')
+        if size[-1:] in units:
+            mix.append((int(float(size[:-1]) * units[size[-1]]), int(count or 1)))
+        else:
+            mix.append((int(size), int(count or 1)))
+    return mix
+
+
+
+def generate_payload(root, size_mix, content='random', seed=0):
+    """ Write files of the sizes in size_mix to root for transfer benchmarks and return their (relpath, size) """
+    rng   = random.Random(seed)
+    block = 1024 ** 2
+    if content == 'random':
+        data = rng.getrandbits(block * 8).to_bytes(block, 'little')
+    else:
+        reads = []
+        while sum(map(len, reads)) < block:
+            bases = ''.join(rng.choices('ACGT', k=100))
+            reads.append(f"@read{len(reads)}\n{bases}\n+\n{'F' * 100}\n".encode())
+        data = b''.join(reads)[:block]
+
+    files = []
+    os.makedirs(root, exist_ok=True)
+    for size, count in size_mix:
+        for i in range(count):
+            relpath = f"f{size}_{i}"
+            with open(os.path.join(root, relpath), 'wb') as f:
+                # start each file at another offset, so rsync can not match blocks between files
+                offset    = rng.randrange(block)
+                rotated   = data[offset:] + data[:offset]
+                remaining = size
+                while remaining > 0:
+                    f.write(rotated[:remaining])
+                    remaining -= len(rotated[:remaining])
+            files.append((relpath, size))
+    return files
+
+
+
+def benchmark_run(check_options):
+    """ Run scan() silenced, in a fresh worker process, and return its measurements """
+    scan_stats.reset()
+    start = time.perf_counter()
+    summary = scan(**check_options)
+    elapsed = time.perf_counter() - start
+    return {'seconds':                 elapsed,
+            'governor':                summary['governor'],
+            'stat_calls':              scan_stats.counters['stat_calls'],
+            'peak_rss_kb':             resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'ownership_write_seconds': scan_stats.counters['ownership_write_time'],
+           }
+
+
+
 #pip install line_profiler
 #kernprof -l darsync.py check -l /path/to/testdir
 #python -m line_profiler darsync.py.lprof
 #@profile
-def check_file_tree(args):
+def scan_file_tree(args, output, on_dir=None):
     """ Traverse a directory tree and check for files with 'uncompressed' extensions 
-        and directories with too many files
+        and directories with too many files. Returns a summary of the results as a dict.
     """
-
-    # print intro message
-    print(msg('check_intro'))
-
-    # Get command line arguments
-    local_dir = args.local_dir or input(msg('input_local_dir'))
-    while not local_dir:
-        local_dir = args.local_dir or input(msg('input_local_dir'))
-        # make sure it is a valid directory
-        if local_dir:
-            if not os.path.isdir(local_dir):
-                print(f"ERROR: not a valid directory, {local_dir}")
-                local_dir = None
-
+    local_dir = args.local_dir
     if args.prefix:
         prefix = args.prefix
     else:
@@ -327,75 +2311,281 @@ def check_file_tree(args):
     # expand tilde
     local_dir = os.path.abspath(os.path.expanduser(local_dir))
     prefix = os.path.abspath(os.path.expanduser(prefix))
-    prefix_basename = os.path.basename(prefix)
 
     # Initialize variables for tracking file counts and sizes
     total_size           = 0
-    uncompressed_files   = []
     total_files          = 0
-    crowded_dirs         = []
     large_count          = 0
     uncompressed_count   = 0
     size_limit           = 2 * 1024 ** 3 # Size limit (2GB)
     files_limit          = 1000000 #   1M
     dir_files_limit      =  100000 # 100K
-    previous_dirpath_len = 0
-
-    # save ownership file in the folder to be transfered
-    with gzip.open(f"{local_dir}/{prefix_basename}.ownership.gz", 'wb') as ownership_file:
+    total_bytes          = 0
+    total_dirs           = 0
+    pending_dirs         = 1
+
+    # classify the files by the built in rules and the user's own
+    try:
+        classifier = Classifier(rules_file=args.rules)
+    except (OSError, ValueError) as e:
+        raise ValueError(f"could not read the classifier rules, {e}") from e
+    # the transfer model for the estimated transfer time, calibrated by bench-link if it has been run
+    try:
+        model = read_transfer_model(args.model, args.cluster or 'rackham')
+    except (OSError, ValueError) as e:
+        raise ValueError(f"could not read the transfer model, {e}") from e
+    category_totals = collections.defaultdict(lambda: [0, 0])
+    sniffed_count   = 0
+    sniff_executor  = ThreadPoolExecutor(max_workers=max(args.jobs, 4)) if args.sniff else None
+
+    # with --stats the time spent in each part of the scan is measured
+    scan_stats.reset()
+    scan_stats.timed = args.stats
+    scan_start = time.perf_counter()
+
+    # in low memory mode the reports are sorted on disk, and directories are read one entry at a time
+    # and handled in batches, which means they can not be stored in the index
+    spill_limit        = 500000 if args.low_memory else None
+    uncompressed_files = size_sorted_list(spill_limit, os.path.dirname(prefix) or None)
+    crowded_dirs       = size_sorted_list(spill_limit, os.path.dirname(prefix) or None)
+    batch_size         = 10000
+
+    # files with more than one link are grouped by inode, and with --dedup larger files are kept by size, one path
+    # per inode, to look for copies among them afterwards. In low memory mode both are sorted on disk instead
+    if args.low_memory:
+        hard_links   = SortedList(spill_limit, os.path.dirname(prefix) or None, key=lambda link: link[:2])
+        size_buckets = SortedList(spill_limit, os.path.dirname(prefix) or None, key=lambda file: file[0]) if args.dedup else None
+    else:
+        hard_links   = {}
+        size_buckets = collections.defaultdict(list) if args.dedup else None
+
+    # keep the load on the metadata servers of shared file systems down, listing directories at a limited
+    # rate and/or as many at a time as the file system keeps up with
+    governor = None
+    if args.max_ops or args.adaptive or args.fake_latency:
+        if args.low_memory:
+            print("WARNING: the scan is not governed with --low-memory, it lists a single directory at a time", file=output)
+        governor = MetadataGovernor(args.jobs, max_rate=args.max_ops, adaptive=args.adaptive, tolerance=args.latency_tolerance,
+                                    latency_model=FakeLatency.parse(args.fake_latency) if args.fake_latency else None)
+
+    # reuse the results from the previous run for directories that have not changed
+    # the manifest needs the current size and mtime of every file, which the index does not have for files changed in place
+    index = None if args.no_index or args.low_memory else ScanIndex(f"{prefix}.index", local_dir, rescan=args.rescan or args.manifest)
+    previous_totals = index.previous_totals() if index else None
+    progress = ScanProgress(expected_files=previous_totals[1] if previous_totals else None, output=output)
+
+    # list everything that should be transferred, so rsync does not have to walk the tree again
+    file_list = gzip.open(f"{prefix}.files.gz", 'wb') if args.file_list else None
+
+    # with --usage the allocated space and the ages of the files are totalled per directory, and sparse files are listed by their holes
+    usage_file   = gzip.open(f"{prefix}.usage.gz", 'wt') if args.usage else None
+    usage_totals = new_usage()
+    sparse_files = size_sorted_list(spill_limit, os.path.dirname(prefix) or None)
+    now_ns       = time.time_ns()
+    if usage_file:
+        usage_file.write("# " + "\t".join(USAGE_FIELDS) + "\tdirectory, with the age classes " + ",".join(AGE_LABELS) + "\n")
+
+    # the files for the manifest are sorted in the order of their path components on disk, as they are not found in that order
+    manifest = SortedList(1000000, os.path.dirname(prefix) or None) if args.manifest else None
+
+    # save ownership file in the folder to be transfered, or in --ownership-dir, compressed in the background
+    ownership_dir  = os.path.abspath(os.path.expanduser(args.ownership_dir or local_dir))
+    ownership_path = ownership_file_path(ownership_dir, prefix, args.ownership_format)
+    ownership_file = OwnershipWriter(ownership_path, local_dir, binary=args.ownership_format == 'binary', jobs=max(args.jobs, 2))
+    # the ownership file is only part of the tree if it is written in its top directory
+    ownership_name = os.path.basename(ownership_path) if ownership_dir == local_dir else None
+    try:
 
         # Walk the directory tree
-        for dirpath, dirnames, filenames in os.walk(local_dir):
-
-            # print progress
-            print(f"\r{dirpath}" + ' '*(previous_dirpath_len-len(dirpath)), end='')
-            previous_dirpath_len = len(dirpath)
-
-            # init
-            dir_file_counter    = 0
+        for dirpath, dir_info, dirnames, files in walk_tree(local_dir, args.jobs, index.cached_listing if index else None, lazy=args.low_memory, governor=governor):
 
             # save directory permissions
-            file_info = os.lstat(dirpath)
-            ownership_file.write(f"{stat.S_IMODE(file_info.st_mode)}\t{file_info.st_uid}\t{file_info.st_gid}\t{dirpath}/\n".encode('utf-8', "surrogateescape"))
-
-            # Loop over files in directory
-            for file in filenames:
-
-                # count file and get file info
-                dir_file_counter += 1
-                total_files      += 1
-                full_path = os.path.join(dirpath, file)
-                file_info = os.lstat(full_path)
-
-                # Check if file has a 'uncompressed' extension
-                if any(file.endswith(ext) for ext in UNCOMPRESSED_FILE_EXTENSIONS):
-                    # Update counters and size totals
-                    if file_info.st_size > size_limit:
-                        large_count    += 1
-                    uncompressed_count += 1
-                    total_size += file_info.st_size
-                    uncompressed_files.append((full_path, file_info.st_size))
+            write_start = time.perf_counter()
+            ownership_file.add_dir(dirpath, dir_info)
+            total_dirs += 1
+            write_time = time.perf_counter() - write_start
+
+            rel_dir = os.path.relpath(dirpath, local_dir) if dirpath != local_dir else ''
+            dir_file_counter = 0
+            dir_bytes        = 0
+            dir_uncompressed = [0, 0]
+            dir_usage = new_usage() if usage_file else None
+            for batch in ([files] if isinstance(files, list) else iter(lambda: list(itertools.islice(files, batch_size)), [])):
+
+                # get the file count, uncompressed files and file ownership info
+                batch_file_counter, batch_uncompressed, batch_categories = summarize_dir(dirpath, batch, classifier)
+
+                # read the start of larger files that are not known to be uncompressed, to find text files with misleading names
+                if sniff_executor:
+                    candidates = [(file, file_info.st_size) for file, file_info in batch if file_info.st_size >= args.sniff_min_size and stat.S_ISREG(file_info.st_mode) and classifier.category(file) != 'uncompressed']
+                    for candidate, is_uncompressed in zip(candidates, sniff_executor.map(lambda candidate: sniff_uncompressed(os.path.join(dirpath, candidate[0])), candidates)):
+                        if is_uncompressed:
+                            batch_uncompressed.append(candidate)
+                            sniffed_count += 1
+                            # count it as uncompressed instead of in the category of its extension
+                            file, size = candidate
+                            totals = batch_categories[classifier.category(file)]
+                            totals[0] -= 1
+                            totals[1] -= size
+                            totals = batch_categories.setdefault('uncompressed', [0, 0])
+                            totals[0] += 1
+                            totals[1] += size
+
+                for file, file_info in [file for file in batch if file[1].st_nlink > 1 and stat.S_ISREG(file[1].st_mode)]:
+                    if args.low_memory:
+                        hard_links.append((file_info.st_dev, file_info.st_ino, file_info.st_size, os.path.join(dirpath, file)))
+                        continue
+                    size, paths = hard_links.setdefault((file_info.st_dev, file_info.st_ino), (file_info.st_size, []))
+                    paths.append(os.path.join(dirpath, file))
+                    if size_buckets is not None and len(paths) == 1 and size >= args.dedup_min_size:
+                        size_buckets[size].append(paths[0])
+                if size_buckets is not None:
+                    for file, file_info in batch:
+                        if file_info.st_nlink == 1 and file_info.st_size >= args.dedup_min_size and stat.S_ISREG(file_info.st_mode):
+                            if args.low_memory:
+                                size_buckets.append((file_info.st_size, os.path.join(dirpath, file)))
+                            else:
+                                size_buckets[file_info.st_size].append(os.path.join(dirpath, file))
+
+                if dir_usage:
+                    batch_sparse = []
+                    account_usage(dir_usage, batch, now_ns, batch_sparse)
+                    for file, holes in batch_sparse:
+                        sparse_files.append((os.path.join(dirpath, file), holes))
+
+                if index:
+                    index.add(dirpath, dir_info, dirnames, batch, batch_uncompressed)
 
                 # add file ownership info
-                ownership_file.write(f"{stat.S_IMODE(file_info.st_mode)}\t{file_info.st_uid}\t{file_info.st_gid}\t{full_path}\n".encode('utf-8', "surrogateescape"))
-
+                write_start = time.perf_counter()
+                ownership_file.add_files(dirpath, batch)
+                write_time += time.perf_counter() - write_start
+
+                # add the files to the transfer file list, relative to local_dir
+                if file_list:
+                    file_list.write(b''.join(os.fsencode(os.path.join(rel_dir, file)) + b'\0' for file, file_info in batch))
+
+                # add the files and symlinks to the manifest, sorted by the path with the '/' between the components as NUL
+                if manifest is not None:
+                    for file, file_info in batch:
+                        # the ownership file is still being written, it is added once it is complete
+                        if not rel_dir and file == ownership_name:
+                            continue
+                        if stat.S_ISREG(file_info.st_mode) or stat.S_ISLNK(file_info.st_mode):
+                            manifest.append((os.fsencode(os.path.join(rel_dir, file)).replace(b'/', b'\0'), file_info.st_mode, file_info.st_size, file_info.st_mtime_ns))
+
+                # Update counters and size totals
+                dir_file_counter += batch_file_counter
+                total_files      += batch_file_counter
+                for file_category, (count, size) in batch_categories.items():
+                    category_totals[file_category][0] += count
+                    category_totals[file_category][1] += size
+                    total_bytes += size
+                    dir_bytes   += size
+                for file, size in batch_uncompressed:
+                    if size > size_limit:
+                        large_count    += 1
+                    uncompressed_count += 1
+                    total_size += size
+                    dir_uncompressed[0] += 1
+                    dir_uncompressed[1] += size
+                    uncompressed_files.append((os.path.join(dirpath, file), size))
+
+                # print progress, not for every directory as the terminal can not keep up with that
+                progress.update(dirpath, total_files, total_bytes, pending_dirs)
+
+            scan_stats.add('ownership_write_time', write_time)
+            pending_dirs += len(dirnames) - 1
+
+            # a line per directory with regular files in the usage file, relative to local_dir
+            if dir_usage and dir_usage[0]:
+                usage_file.write(f"{format_usage(dir_usage)}\t{rel_dir}\n")
+                usage_totals = [total + value for total, value in zip(usage_totals, dir_usage)]
+
+            # symlinks to directories are listed with the subdirectories, but darsync manifest records them like files
+            if manifest is not None:
+                for name in dirnames:
+                    try:
+                        link_info = os.lstat(os.path.join(dirpath, name))
+                    except OSError:
+                        continue
+                    if stat.S_ISLNK(link_info.st_mode):
+                        manifest.append((os.fsencode(os.path.join(rel_dir, name)).replace(b'/', b'\0'), link_info.st_mode, link_info.st_size, link_info.st_mtime_ns))
+
+            # add the subdirectories to the transfer file list, they are only all known once the files have been read
+            if file_list:
+                file_list.write(b''.join(os.fsencode(os.path.join(rel_dir, name)) + b'\0' for name in dirnames))
 
             # check if the dir is too crowded
             if dir_file_counter > dir_files_limit:
                 crowded_dirs.append((os.path.abspath(dirpath), dir_file_counter))
 
+            if on_dir:
+                on_dir({'type': 'dir', 'path': rel_dir or '.', 'files': dir_file_counter, 'bytes': dir_bytes, 'subdirs': len(dirnames),
+                        'uncompressed_files': dir_uncompressed[0], 'uncompressed_bytes': dir_uncompressed[1], 'crowded': dir_file_counter > dir_files_limit})
+
+        progress.update(dirpath, total_files, total_bytes, pending_dirs, force=True)
+    finally:
+        ownership_file.close()
+
+    if file_list:
+        file_list.close()
+
+    if usage_file:
+        usage_file.close()
+
+    # write the manifest that darsync diff compares with one of the destination
+    if manifest is not None and ownership_name:
+        # the complete ownership file, so it is sent again rather than deleted on the other side by gen --delta-delete
+        ownership_info = os.lstat(ownership_path)
+        manifest.append((os.fsencode(ownership_name), ownership_info.st_mode, ownership_info.st_size, ownership_info.st_mtime_ns))
+    if manifest is not None:
+        entries = ((key.replace(b'\0', b'/'), ManifestEntry(*values)) for key, *values in manifest)
+        write_manifest(local_dir, f"{prefix}.manifest.gz", jobs=max(args.jobs, 4), entries=entries, hash_files=args.manifest_hash)
+        manifest.close()
+        print(f"\n\nWrote a manifest of the files{' with checksums' if args.manifest_hash else ''} to {prefix}.manifest.gz", file=output)
+
+    if sniff_executor:
+        sniff_executor.shutdown()
+
+    if index:
+        index.close()
+        print(f"\n\nReused results from {prefix}.index for {index.reused} unchanged directories.", file=output)
+
+    if governor:
+        governed = governor.summary()
+        print(f"\n\nThe scan made {governed['ops']} metadata operations, {governed['ops_per_second']:.0f} per second, listing {governed['mean_concurrency']:.1f} directories at a time on average.", file=output)
+
+    # summarize where the time went
+    if args.stats:
+        scan_time = time.perf_counter() - scan_start
+        timers = {'list': scan_stats.counters['list_time'], 'stat': scan_stats.counters['stat_time'],
+                  'match': scan_stats.counters['match_time'], 'ownership_write': scan_stats.counters['ownership_write_time']}
+        summary = {'local_dir': local_dir, 'jobs': args.jobs, 'low_memory': args.low_memory, 'reused_dirs': index.reused if index else 0,
+                   'seconds': scan_time, 'files': total_files, 'bytes': total_bytes, 'stat_calls': scan_stats.counters['stat_calls'],
+                   'files_per_second': total_files / scan_time if scan_time else 0, 'timers': timers,
+                   'other': max(scan_time - sum(timers.values()), 0), 'timers_summed_over_threads': args.jobs > 1 and not args.low_memory,
+                   'governor': governor.summary() if governor else None}
+        with open(f"{prefix}.stats.json", 'w') as f:
+            json.dump(summary, f, indent=2)
+        print(msg('check_stats', timing_table="\n".join(f"{seconds:.2f}\t{name}" for name, seconds in list(timers.items()) + [('other', summary['other'])]), **summary, prefix=prefix), file=output)
+
 
 
 
     # set file permissions for the ownership file
-    os.chmod(f"{local_dir}/{prefix_basename}.ownership.gz", 0o650)
+    os.chmod(ownership_path, 0o650)
 
-    # Sort files by size
-    uncompressed_files.sort(key=lambda x: x[1], reverse=True)
+    # print how much of the data is in each category
+    category_table = "\n".join(f"{count}\t{human_readable_size(size)}\t{file_category}" for file_category, (count, size) in sorted(category_totals.items(), key=lambda x: x[1][1], reverse=True) if count)
+    sniffed = f"\n{sniffed_count} files without uncompressed file extensions look like uncompressed text, they are\ncounted as uncompressed above and included with the uncompressed files below.\n" if args.sniff else ""
+    print(msg('category_totals', category_table=category_table, sniffed=sniffed), file=output)
 
     # If any large or 'uncompressed' files found, print warning message and write logfile
     if large_count > 0 or total_size > size_limit or args.devel:
-        print(msg('uncompressed_warning', uncompressed_count=uncompressed_count, large_count=large_count, human_readable_size_limit=human_readable_size(size_limit), human_readable_save_size=human_readable_size(total_size*0.75), UNCOMPRESSED_FILE_EXTENSIONS_STR=", ".join(UNCOMPRESSED_FILE_EXTENSIONS), prefix=prefix, human_readable_total_size=human_readable_size(total_size)))
+        largest_files = "\n".join(f"{human_readable_size(size)}\t{file}" for file, size in uncompressed_files.largest())
+        print(msg('uncompressed_warning', uncompressed_count=uncompressed_count, large_count=large_count, human_readable_size_limit=human_readable_size(size_limit), human_readable_save_size=human_readable_size(total_size*0.75), UNCOMPRESSED_FILE_EXTENSIONS_STR=", ".join(classifier.suffixes('uncompressed')), prefix=prefix, human_readable_total_size=human_readable_size(total_size), largest_files=largest_files), file=output)
+        # files sorted by size
         with open(f"{prefix}.uncompressed", 'w') as logfile:
             for file, size in uncompressed_files:
                 logfile.write(f"{human_readable_size(size)} {file}\n")
@@ -403,118 +2593,1016 @@ def check_file_tree(args):
 
 
 
-    # Sort folders by number of files
-    crowded_dirs.sort(key=lambda x: x[1], reverse=True)
+    # measure how much compressing the 'uncompressed' files would actually save
+    if args.estimate_compression and uncompressed_files:
+        sampled_files, sampled_size, elapsed, per_ext, per_dir = estimate_compression(uncompressed_files, byte_budget=args.sample_budget * 1024 ** 2, time_budget=args.time_budget, jobs=max(args.jobs, 4), classifier=classifier)
+        save_size = sum(saved for total, saved, raw, compressed in per_ext.values())
+        extension_table = "\n".join(f"{human_readable_size(saved)}\t{compressed / raw if raw else 1 - saved / total:.2f}\t{human_readable_size(total)}\t{ext}" for ext, (total, saved, raw, compressed) in sorted(per_ext.items(), key=lambda x: x[1][1], reverse=True) if saved > 0)
+        # the extensions whose samples did not get smaller are listed apart from the savings
+        not_worth = [ext for ext, (total, saved, raw, compressed) in per_ext.items() if saved <= 0]
+        not_worth_note = f"\n\nNot worth compressing, as the samples did not get smaller: {', '.join(not_worth)}" if not_worth else ""
+        print(msg('compression_estimate', sampled_files=sampled_files, human_readable_sampled_size=human_readable_size(sampled_size), elapsed=elapsed, human_readable_save_size=human_readable_size(save_size), save_percent=100 * save_size / total_size if total_size else 0, human_readable_save_time=human_readable_time(save_size / TRANSFER_RATE), human_readable_transfer_rate=human_readable_size(TRANSFER_RATE), extension_table=extension_table, not_worth_note=not_worth_note, prefix=prefix), file=output)
+        with open(f"{prefix}.compression", 'w') as logfile:
+            for dir, (total, saved, raw, compressed) in sorted(per_dir.items(), key=lambda x: x[1][1], reverse=True):
+                if saved > 0:
+                    logfile.write(f"{human_readable_size(saved)} {human_readable_size(total)} {dir}\n")
+            not_worth_dirs = sorted(((total, dir) for dir, (total, saved, raw, compressed) in per_dir.items() if saved <= 0), reverse=True)
+            if not_worth_dirs:
+                logfile.write("# not worth compressing, total size and directory:\n")
+                for total, dir in not_worth_dirs:
+                    logfile.write(f"{human_readable_size(total)} {dir}\n")
+
+    # files that are linked from more than one path in the tree are sent once for each path, unless rsync is told to keep hard links
+    if args.low_memory:
+        hard_link_groups = SortedList(spill_limit, os.path.dirname(prefix) or None, key=lambda group: group[0] * (len(group[1]) - 1), reverse=True)
+        for inode, links in itertools.groupby(hard_links, key=lambda link: link[:2]):
+            links = list(links)
+            size  = links[0][2]
+            paths = [link[3] for link in links]
+            if len(paths) > 1:
+                hard_link_groups.append((size, paths))
+            if size_buckets is not None and size >= args.dedup_min_size:
+                size_buckets.append((size, paths[0]))
+        hard_links.close()
+    else:
+        hard_link_groups = sorted((group for group in hard_links.values() if len(group[1]) > 1), key=lambda group: group[0] * (len(group[1]) - 1), reverse=True)
+    hard_link_bytes  = sum(size * (len(paths) - 1) for size, paths in hard_link_groups)
+    if hard_link_groups:
+        print(msg('hard_links', n_groups=len(hard_link_groups), n_links=sum(len(paths) for size, paths in hard_link_groups), human_readable_hard_link_size=human_readable_size(hard_link_bytes), prefix=prefix), file=output)
+        with open(f"{prefix}.hardlinks", 'w') as logfile:
+            for size, paths in hard_link_groups:
+                logfile.write(f"{human_readable_size(size)} {len(paths)} links\n" + "".join(f"{path}\n" for path in paths) + "\n")
+    elif os.path.exists(f"{prefix}.hardlinks"):
+        # gen keeps hard links if this file exists
+        os.remove(f"{prefix}.hardlinks")
+
+    # look for copies of the same content among files of the same size
+    duplicate_bytes = 0
+    if size_buckets is not None:
+        dedup_start = time.perf_counter()
+        if args.low_memory:
+            duplicates = find_duplicates(((size, [path for size, path in files]) for size, files in itertools.groupby(size_buckets, key=lambda file: file[0])), jobs=max(args.jobs, 4))
+            size_buckets.close()
+        else:
+            duplicates = find_duplicates(size_buckets.items(), jobs=max(args.jobs, 4))
+        duplicate_bytes = sum(size * (len(paths) - 1) for size, paths in duplicates)
+        largest_duplicates = "\n".join(f"{human_readable_size(size * (len(paths) - 1))}\t{len(paths)}\t{paths[0]}" for size, paths in duplicates[:10])
+        print(msg('duplicates', n_groups=len(duplicates), n_files=sum(len(paths) for size, paths in duplicates), human_readable_min_size=human_readable_size(args.dedup_min_size), elapsed=time.perf_counter() - dedup_start, human_readable_duplicate_size=human_readable_size(duplicate_bytes), largest_duplicates=largest_duplicates, prefix=prefix), file=output)
+        with open(f"{prefix}.duplicates", 'w') as logfile:
+            for size, paths in duplicates:
+                logfile.write(f"{human_readable_size(size * (len(paths) - 1))} {len(paths)} copies of {human_readable_size(size)}\n" + "".join(f"{path}\n" for path in paths) + "\n")
+
+    # the space the files take up, and how long ago they were used
+    if args.usage:
+        n_ages    = len(AGE_LABELS)
+        age_table = "\n".join(f"{label}\t{human_readable_size(modified)}\t{human_readable_size(accessed)}" for label, modified, accessed in zip(AGE_LABELS, usage_totals[6:6 + n_ages], usage_totals[6 + n_ages:]))
+        sparse_note = msg('sparse_note', prefix=prefix) if sparse_files else ""
+        print(msg('usage', n_files=usage_totals[0], human_readable_size=human_readable_size(usage_totals[1]), human_readable_allocated=human_readable_size(usage_totals[2]),
+                  sparse_files=usage_totals[3], human_readable_holes=human_readable_size(usage_totals[4]), sparse_note=sparse_note, age_table=age_table,
+                  human_readable_hot=human_readable_size(usage_totals[5]), hot_days=HOT_DAYS, prefix=prefix), file=output)
+        if sparse_files:
+            with open(f"{prefix}.sparse", 'w') as logfile:
+                for file, holes in sparse_files:
+                    logfile.write(f"{human_readable_size(holes)} {file}\n")
+        elif os.path.exists(f"{prefix}.sparse"):
+            # gen keeps sparse files sparse if this file exists
+            os.remove(f"{prefix}.sparse")
 
     # If any large or 'uncompressed' files found, print warning message and write logfile
     if len(crowded_dirs) > 0 or total_files > files_limit or args.devel:
-        print(msg("too_many_files_warning", crowded_dirs_len=len(crowded_dirs), dir_files_limit=dir_files_limit, total_files=total_files, files_limit=files_limit, prefix=prefix))
+        print(msg("too_many_files_warning", crowded_dirs_len=len(crowded_dirs), dir_files_limit=dir_files_limit, total_files=total_files, files_limit=files_limit, prefix=prefix), file=output)
+        # folders sorted by number of files
         with open(f"{prefix}.dir_n_files", 'w') as logfile:
             for dir, n_files in crowded_dirs:
                 logfile.write(f"{n_files} {dir}\n")
 
-    print(msg('check_outro', ownership_file_path=f"{local_dir}/{prefix_basename}.ownership.gz"))
+    uncompressed_files.close()
+    crowded_dirs.close()
+    sparse_files.close()
+    if args.low_memory:
+        hard_link_groups.close()
 
+    print(msg('check_outro', ownership_file_path=ownership_path, ownership_file_name=os.path.basename(ownership_path)), file=output)
 
+    return {'local_dir': local_dir, 'prefix': prefix, 'files': total_files, 'bytes': total_bytes, 'crowded_dirs': len(crowded_dirs),
+            'uncompressed_files': uncompressed_count, 'uncompressed_bytes': total_size, 'large_uncompressed_files': large_count,
+            'governor': governor.summary() if governor else None, 'hard_link_groups': len(hard_link_groups), 'hard_link_bytes': hard_link_bytes, 'duplicate_bytes': duplicate_bytes,
+            'usage': dict(zip(USAGE_FIELDS, usage_totals[:6] + [usage_totals[6:6 + len(AGE_LABELS)], usage_totals[6 + len(AGE_LABELS):]])) if args.usage else None,
+            'estimated_transfer_seconds': predict_transfer(model, total_files + total_dirs, total_bytes)}
 
-def gen_slurm_script(args):
-    """ Generate a SLURM script for transferring files """
+
+
+def check_file_tree(args):
+    """ The check command, asks for the directory if it was not given and runs scan() """
+
+    # with --json stdout only gets a line of JSON per directory and one with the summary, the messages go to stderr
+    output = sys.stderr if args.json else sys.stdout
 
     # print intro message
-    print(msg('gen_intro'))
+    print(msg('check_intro'), file=output)
 
-    # Get command line arguments, with defaults for hostname and SSH key
-    hostname_default = 'dardel.pdc.kth.se'
-    ssh_key_default  = f"{os.environ['HOME']}/id_ed25519_pdc"
-    cluster_default  = 'rackham'
+    # ask for the directory until a valid one is given
+    local_dir = args.local_dir
+    while not local_dir:
+        local_dir = ask(args, 'input_local_dir')
+        if local_dir and not os.path.isdir(os.path.expanduser(local_dir)):
+            print(f"ERROR: not a valid directory, {local_dir}", file=output)
+            local_dir = None
+
+    on_dir  = (lambda record: print(json.dumps(record), flush=True)) if args.json else None
+    summary = scan(**dict(vars(args), local_dir=local_dir, output=output, on_dir=on_dir))
+    if args.json:
+        print(json.dumps(dict(summary, type='summary')))
+    return summary
+
+
+
+def plan_file_transfer(args, output):
+    """ Plan the transfer of a directory, write the SLURM script unless args.dryrun and return the plan as a dict """
+    local_dir     = args.local_dir
+    slurm_account = args.slurm_account
+    username      = args.username
+    remote_dir    = args.remote_dir
+    ssh_key       = os.path.expanduser(args.ssh_key)
+    hostname      = args.hostname or 'dardel.pdc.kth.se'
+    cluster       = args.cluster or 'rackham'
+    if cluster not in ['rackham', 'snowy']:
+        print(f"WARNING: Cluster not rackham or snowy, {cluster}", file=output)
+    outfile = args.outfile or f"~/darsync_{os.path.basename(os.path.abspath(local_dir))}.slurm"
+    outfile = os.path.abspath(os.path.expanduser(outfile))
 
-    # Get command line arguments
-    local_dir = args.local_dir or input(msg('input_local_dir'))
+    job_name = f"darsync_{os.path.basename(os.path.abspath(local_dir))}"
+    log_dir  = os.path.abspath(os.path.expanduser("~/"))
+    prefix   = os.path.abspath(os.path.expanduser(args.prefix or f"~/{job_name}"))
+    # the transfer model, with the ssh cipher and rsync compression found best by bench-link if it has been run
+    try:
+        model = read_transfer_model(args.model, cluster)
+    except (OSError, ValueError) as e:
+        raise ValueError(f"could not read the transfer model, {e}") from e
+    ssh      = f"ssh -i {os.path.abspath(ssh_key)} -o StrictHostKeyChecking=no" + (f" -c {model['ssh_cipher']}" if model['ssh_cipher'] else "")
+
+    # without -c rsync compares files by size and modification time, and the checksums are compared in a separate verification stage instead
+    rsync    = f'rsync -e "{ssh}" -aPuv' if args.verify else f'rsync -e "{ssh}" -acPuv'
+    # with a progress log rsync reports its total progress instead of every file, and it is recorded by darsync itself
+    darsync_path = os.path.realpath(__file__)
+    if args.progress_log:
+        rsync = rsync.replace('Puv', 'u --partial --info=progress2')
+    if model['rsync_compress']:
+        rsync += " -z"
+    target   = f"{os.path.abspath(local_dir)}/ {username}@{hostname}:{remote_dir}"
+
+    # keep files that are linked from several paths as one file with several links, instead of sending a copy for each path
+    hard_links = args.hard_links or os.path.isfile(f"{prefix}.hardlinks")
+    if hard_links:
+        rsync += " -H"
+
+    # write the holes of sparse files as holes on the remote system, instead of as blocks of zeros. The holes are still
+    # read as zeros and sent, so if they are a large part of the data they are compressed on the way, where they cost next to nothing
+    sparse       = args.sparse or os.path.isfile(f"{prefix}.sparse")
+    sparse_holes = 0
+    if sparse:
+        rsync += " --sparse"
+        usage_totals = new_usage()
+        if os.path.isfile(f"{prefix}.usage.gz") and not args.delta:
+            for rel_dir, usage in read_usage(f"{prefix}.usage.gz"):
+                usage_totals = [total + value for total, value in zip(usage_totals, usage)]
+        if usage_totals[4] >= 0.1 * usage_totals[1] and usage_totals[4] and not model['rsync_compress']:
+            rsync += " -z"
+            sparse_holes = usage_totals[4]
+            print(f"The sparse files have {human_readable_size(sparse_holes)} of holes, rsync compresses the data to not send them as zeros (-z).", file=output)
+
+    sbatch_options = [f"-A {slurm_account}",
+                      f"-M {cluster}",
+                      "-t 10-00:00:00",
+                      "-p core",
+                      ]
+
+    # the crowded directories found by check are sent as tar streams instead of file by file
+    if args.pack_crowded:
+        pack_dir = f"{outfile}.pack"
+        try:
+            crowded_dirs = [dirpath for n_files, dirpath in read_crowded_dirs(f"{prefix}.dir_n_files")]
+        except OSError as e:
+            raise ValueError(f"could not read the crowded directories, run `darsync check` first: {e}") from e
+        pack_units = plan_packing(crowded_dirs, os.path.abspath(local_dir), f"{prefix}.index", None if args.dryrun else pack_dir)
+        rsync += f" --exclude-from={pack_dir}/exclude"
+
+    # what check found, to size the job with
+    scan_totals = read_scan_totals(f"{prefix}.index")
+
+    # a follow-up transfer of only the files darsync diff found to be new or changed
+    if args.delta:
+        delta = os.path.abspath(os.path.expanduser(args.delta))
+        try:
+            with open(f"{delta}.summary.json") as f:
+                delta_totals = json.load(f)
+        except (OSError, ValueError) as e:
+            raise ValueError(f"could not read the lists of changed files, run `darsync diff` first: {e}") from e
+        scan_totals = (0, delta_totals['new']['files'] + delta_totals['changed']['files'], delta_totals['new']['bytes'] + delta_totals['changed']['bytes'])
+    elif args.delta_delete:
+        raise ValueError("--delta-delete needs --delta")
+
+    # compressed holes are not part of the data that has to be sent
+    if scan_totals is not None and sparse_holes:
+        n_dirs, n_files, n_bytes = scan_totals
+        scan_totals = (n_dirs, n_files, max(n_bytes - sparse_holes, 0))
+
+    # use as many streams as it takes to finish within the target time
+    if args.auto_partitions:
+        if scan_totals is None:
+            raise FileNotFoundError(f"--auto-partitions needs the index from check, run `darsync check` first: {prefix}.index")
+        n_dirs, n_files, n_bytes = scan_totals
+        packed_files  = sum(n_files for rel_dir, n_files, n_bytes in pack_units) if args.pack_crowded else 0
+        packed_bytes  = sum(n_bytes for rel_dir, n_files, n_bytes in pack_units) if args.pack_crowded else 0
+        single_stream = predict_transfer(model, n_dirs + n_files, n_bytes, 1, packed_files, packed_bytes, args.verify) * model['safety_factor']
+        args.partitions = min(max(math.ceil(single_stream / model['target_time']), 1), model['max_streams'])
+        args.concurrent = args.concurrent or args.partitions > 1
+
+    # checked after --auto-partitions, which can split the transfer into partitions as well
+    if args.delta and (args.partitions > 1 or args.file_list or args.pack_crowded):
+        raise ValueError("--delta gives rsync its own file list, it can not be combined with --partitions, --auto-partitions, --file-list or --pack-crowded")
+
+    # the hot data is sent first in chunks of the file list, reordered by directory
+    if args.hot_first:
+        if args.partitions > 1 or args.delta:
+            raise ValueError("--hot-first orders the file list from check, it can not be combined with --partitions or --delta")
+        args.file_list   = True
+        args.chunk_files = args.chunk_files or 100000
+
+    # a resumable transfer needs to be split up, into partitions or into chunks of the file list
+    if args.resumable and args.partitions <= 1 and not args.delta:
+        args.file_list   = True
+        args.chunk_files = args.chunk_files or 100000
+
+    if args.partitions > 1 and args.file_list:
+        raise ValueError("--partitions already gives rsync file lists, it can not be combined with --file-list")
+
+    if args.partitions > 1 and args.verify and not args.concurrent:
+        raise ValueError("--verify needs all partitions to finish before verifying, use it together with --concurrent")
+
+    if args.partitions > 1 and hard_links:
+        print("WARNING: hard links are only kept between paths sent by the same rsync stream, a file linked from several partitions is sent once for each of them.", file=output)
+
+    # predict how long the transfer takes and size the walltime after it, unless it was given
+    prediction = None
+    if scan_totals is not None:
+        n_dirs, n_files, n_bytes = scan_totals
+        packed_files = sum(n_files for rel_dir, n_files, n_bytes in pack_units) if args.pack_crowded else 0
+        packed_bytes = sum(n_bytes for rel_dir, n_files, n_bytes in pack_units) if args.pack_crowded else 0
+        seconds      = predict_transfer(model, n_dirs + n_files, n_bytes, args.partitions, packed_files, packed_bytes, args.verify)
+        walltime     = min(max(seconds * model['safety_factor'], model['min_time']), model['max_time'])
+        prediction   = {'dirs': n_dirs, 'files': n_files, 'bytes': n_bytes, 'streams': args.partitions, 'seconds': round(seconds), 'walltime': slurm_time(walltime), 'model': model}
+        if seconds * model['safety_factor'] > model['max_time']:
+            print(f"WARNING: the transfer is predicted to take {human_readable_time(seconds)}, longer than a job can run. Consider --partitions or --auto-partitions.", file=output)
+    if args.time:
+        sbatch_options[2] = f"-t {args.time}"
+    elif prediction:
+        sbatch_options[2] = f"-t {prediction['walltime']}"
+
+    # stages after the transfer need to know if it failed, so the script keeps track of it in $status
+    later_stages = args.verify or args.pack_crowded
+    track_status = later_stages or args.concurrent or args.chunk_files or args.resumable or args.delta_delete
+
+    # in a resumable script each chunk, partition or archive is a unit that is marked as done in the state directory
+    state_dir = f"{outfile}.state"
+    def unit(name, command):
+        return f"run_unit {name} {shlex.quote(command)}" if args.resumable else command
+
+    # with a progress log the transfers are run by `darsync record-progress`, which snapshots their progress
+    progress_log = f"{outfile}.progress"
+    def record(name, command):
+        return f"record {name} {shlex.quote(command)}" if args.progress_log else command
+    def transfer(name, command):
+        return unit(name, record(name, command))
+
+    if args.partitions > 1:
+        # split the transfer into partitions with their own file lists
+        list_prefix   = f"{outfile}.files"
+        rsync_command = f"{rsync} --from0 --files-from={list_prefix}.$SLURM_ARRAY_TASK_ID {target}"
+
+        if args.concurrent:
+            # one job running one rsync stream per partition
+            sbatch_options += [f"-n {args.partitions}",
+                               f"-J {job_name}",
+                               f"--output={log_dir}/{job_name}.out",
+                               f"--error={log_dir}/{job_name}.err",
+                               ]
+            body = f"""# run one rsync stream per partition
+pids=()
+for SLURM_ARRAY_TASK_ID in $(seq 0 {args.partitions - 1}); do
+    {transfer("partition.$SLURM_ARRAY_TASK_ID", rsync_command)} &
+    pids+=($!)
+done
+
+# fail if any of the streams failed
+status=0
+for pid in "${{pids[@]}}"; do
+    wait $pid || status=1
+done
+"""
+        else:
+            # a job array with one rsync stream per array task
+            sbatch_options += ["-n 1",
+                               f"--array=0-{args.partitions - 1}",
+                               f"-J {job_name}",
+                               f"--output={log_dir}/{job_name}_%a.out",
+                               f"--error={log_dir}/{job_name}_%a.err",
+                               ]
+            body = f"status=0\n{transfer('partition.$SLURM_ARRAY_TASK_ID', rsync_command)} || status=1\n" if track_status else f"{transfer('partition.$SLURM_ARRAY_TASK_ID', rsync_command)}\n"
+
+    else:
+        sbatch_options += ["-n 1",
+                           f"-J {job_name}",
+                           f"--output={log_dir}/{job_name}.out",
+                           f"--error={log_dir}/{job_name}.err",
+                           ]
+
+        if args.delta:
+            # rsync only looks at the files that are new or changed since the manifest of the destination was made
+            rsync_command = f"{rsync} --from0 --files-from={delta}.transfer {target}"
+        elif args.file_list:
+            # rsync only looks at the files in the list from check, instead of walking the tree again
+            list_path = f"{prefix}.files.gz"
+            if not os.path.isfile(list_path):
+                raise FileNotFoundError(f"file list not found, run `darsync check --file-list` first: {list_path}")
+
+            # rsync does not apply the exclude rules of the crowded directories to files that are listed explicitly,
+            # so the files sent as tar archives are taken out of the list, as are the directories themselves
+            packed_dirs = {os.fsencode(rel_dir) for rel_dir, n_files, n_bytes in pack_units} if args.pack_crowded else set()
+
+            # the list is reordered or filtered into a list of its own next to the script
+            script_list = f"{outfile}.files.gz" if args.hot_first or packed_dirs else list_path
+            if args.hot_first:
+                usage_path = f"{prefix}.usage.gz"
+                if not os.path.isfile(usage_path):
+                    raise FileNotFoundError(f"usage file not found, run `darsync check --usage` first: {usage_path}")
+                if not args.dryrun:
+                    order_file_list(list_path, usage_path, script_list, tmp_dir=os.path.dirname(outfile), exclude_dirs=packed_dirs)
+            elif packed_dirs and not args.dryrun:
+                with gzip.open(script_list, 'wb') as filtered_list:
+                    for entry in read_file_list(list_path, packed_dirs):
+                        filtered_list.write(entry + b'\0')
+
+            if args.chunk_files:
+                chunk_prefix  = f"{outfile}.chunk"
+                rsync_command = f"zcat {chunk_prefix}.$chunk.gz | {rsync} --from0 --files-from=- {target}"
+                if args.dryrun:
+                    n_chunks  = split_file_list(list_path, chunk_prefix, args.chunk_files, write=False, exclude_dirs=packed_dirs)
+                else:
+                    n_chunks  = split_file_list(script_list, chunk_prefix, args.chunk_files)
+                body = f"""# transfer the files in chunks of at most {args.chunk_files} files, to limit the memory rsync needs
+status=0
+for chunk in $(seq 0 {n_chunks - 1}); do
+    {transfer("chunk.$chunk", rsync_command)} || status=1
+done
+"""
+            else:
+                rsync_command = f"zcat {script_list} | {rsync} --from0 --files-from=- {target}"
+        else:
+            rsync_command = f"{rsync} {target}"
+
+        if not args.chunk_files:
+            body = f"status=0\n{transfer('transfer', rsync_command)} || status=1\n" if track_status else f"{transfer('transfer', rsync_command)}\n"
+
+    if args.verify:
+        resend       = f'rsync -e "{ssh}" -a --partial --info=progress2 -I' if args.progress_log else f'rsync -e "{ssh}" -aPv -I'
+        verify_dir   = f"{outfile}.verify"
+        exclude      = f" --exclude-dirs {pack_dir}/dirs" if args.pack_crowded else ""
+        body += f"""
+# verify the transfer by comparing checksum manifests of both sides, computed at the same time
+mkdir -p {verify_dir}
+python3 {darsync_path} manifest -l {os.path.abspath(local_dir)} -o {verify_dir}/local.manifest.gz{exclude} &
+local_pid=$!
+{ssh} {username}@{hostname} "python3 - manifest -l {remote_dir} -o -" < {darsync_path} > {verify_dir}/remote.manifest.gz || exit 1
+wait $local_pid || exit 1
+python3 {darsync_path} verify {verify_dir}/local.manifest.gz {verify_dir}/remote.manifest.gz -o {verify_dir}/mismatches || exit 1
+
+# send the files that are missing or differ again, regardless of their size and modification time,
+# the job still fails if the transfer before it failed
+if [ -s {verify_dir}/mismatches ]; then
+    {record('verify.resend', f'{resend} --from0 --files-from={verify_dir}/mismatches {target}')} || status=1
+fi
+"""
+
+    if args.delta_delete:
+        remove = f"cd {shlex.quote(remote_dir)} && xargs -0 rm -f --"
+        body += f"""
+# remove the files that have been deleted locally since the manifest of the destination was made
+{ssh} {username}@{hostname} {shlex.quote(remove)} < {delta}.deleted || status=1
+"""
+
+    if args.pack_crowded and pack_units:
+        pack_lines = []
+        for i, (rel_dir, n_files, n_bytes) in enumerate(pack_units):
+            remote_tar = posixpath.join(remote_dir, f"{rel_dir}.tar")
+            remote_cmd = f"mkdir -p {shlex.quote(posixpath.dirname(remote_tar))} && cat > {shlex.quote(remote_tar)}"
+            send_tar   = f"tar -C {shlex.quote(os.path.abspath(local_dir))} -cvf - --index-file={pack_dir}/{i}.index -- {shlex.quote(rel_dir)} | {ssh} {username}@{hostname} {shlex.quote(remote_cmd)}"
+            send_index = f"{ssh} {username}@{hostname} {shlex.quote('cat > ' + shlex.quote(remote_tar + '.index'))} < {pack_dir}/{i}.index"
+            if args.resumable:
+                pack_lines.append(f"{unit(f'pack.{i}', f'{send_tar} && {send_index}')} || status=1")
+            else:
+                pack_lines.append(f"{send_tar} || status=1")
+                pack_lines.append(f"{send_index} || status=1")
+        pack_body = "set -o pipefail\n" + "\n".join(pack_lines) + "\n"
+        # only one of the array tasks sends the archives
+        if args.partitions > 1 and not args.concurrent:
+            pack_body = f'if [ "$SLURM_ARRAY_TASK_ID" = 0 ]; then\n{pack_body}fi\n'
+        body += f"""
+# stream the crowded directories as tar archives, without creating the archives on disk first,
+# see {pack_dir}/plan for what is in each archive
+{pack_body}"""
+
+    if track_status:
+        body += "exit $status\n"
+
+    if args.resumable:
+        sbatch_options += ["--requeue", f"--signal=B:USR1@{args.signal_time}"]
+        body = f"""# resumable transfer, finished units are marked in the state directory and skipped when the job runs again.
+# SLURM sends USR1 {args.signal_time} seconds before the time limit, then the running transfers are stopped and
+# the job is requeued, rsync keeps the partially sent files. Remove {state_dir} to start over.
+set -o pipefail
+state_dir={state_dir}
+mkdir -p $state_dir
+
+run_unit() {{
+    if [ -e "$state_dir/$1.done" ]; then
+        echo "darsync: $1 is already done, skipping it"
+        return 0
+    fi
+    ( eval "$2" ) &
+    wait $! && touch "$state_dir/$1.done"
+}}
+
+stop_tree() {{
+    local child
+    for child in $(pgrep -P $1); do
+        stop_tree $child
+    done
+    kill -TERM $1 2>/dev/null
+}}
+
+stop_transfers() {{
+    for child in $(pgrep -P $$); do
+        stop_tree $child
+    done
+    wait
+}}
+
+requeue() {{
+    echo "darsync: the time limit is near, stopping and requeueing the job"
+    stop_transfers
+    job=${{SLURM_ARRAY_JOB_ID:+${{SLURM_ARRAY_JOB_ID}}_$SLURM_ARRAY_TASK_ID}}
+    scontrol requeue ${{job:-$SLURM_JOB_ID}}
+    exit 0
+}}
+
+trap requeue USR1
+trap 'stop_transfers; exit 143' TERM
+
+""" + body
+
+    if args.progress_log:
+        body = f"""# progress of the transfers, summarized by `darsync status {outfile}`
+progress_log={progress_log}
+record() {{
+    python3 {darsync_path} record-progress --unit "$1" --interval {args.progress_interval} $progress_log -- bash -c "$2"
+}}
+# loop variables used in the transfer commands, which run in a shell of their own
+export chunk SLURM_ARRAY_TASK_ID
+
+""" + body
+
+    # record the prediction, so it can be compared with how long the job actually took
+    if prediction:
+        body = f"""# darsync predicted that this transfer takes {human_readable_time(prediction['seconds'])}: {prediction['files']} files and {prediction['dirs']} directories,
+# {human_readable_size(prediction['bytes'])}, sent by {prediction['streams']} rsync stream(s)
+# darsync-prediction {json.dumps(prediction)}
+trap 'echo "darsync: finished after $SECONDS seconds, {prediction['seconds']} seconds were predicted"' EXIT
+
+""" + body
+
+    script = "#!/bin/bash -l\n" + "".join(f"#SBATCH {option}\n" for option in sbatch_options) + "\n" + body
+
+    if args.dryrun:
+        print(f"""
+
+
+
+Dry run.
+Would have created SLURM script: {outfile}
+
+containing the this:
+
+{script}
+""", file=output)
+        if args.partitions > 1:
+            print(f"and {args.partitions} file lists, {list_prefix}.0 - {list_prefix}.{args.partitions - 1}\n", file=output)
+
+    else:
+        if args.partitions > 1:
+            # use the file lists from the check run to plan the partitions
+            try:
+                # the crowded directories sent as tar archives are left out of the lists
+                packed_dirs = {rel_dir for rel_dir, n_files, n_bytes in pack_units} if args.pack_crowded else set()
+                partitions  = plan_partitions(f"{prefix}.index", os.path.abspath(local_dir), args.partitions, list_prefix, exclude_dirs=packed_dirs)
+            except (OSError, ValueError, sqlite3.DatabaseError) as e:
+                raise ValueError(f"could not plan the partitions, run `darsync check` first: {e}") from e
+
+            print("\n\nPartitions:\n", file=output)
+            for i, (n_files, n_bytes) in enumerate(partitions):
+                print(f"{list_prefix}.{i}\t{n_files} files\t{human_readable_size(n_bytes)}", file=output)
+
+        if args.pack_crowded:
+            print(f"\n\n{len(pack_units)} crowded directories will be sent as tar archives, see {pack_dir}/plan\n", file=output)
+            for rel_dir, n_files, n_bytes in pack_units:
+                print(f"{rel_dir}.tar\t{n_files} files\t{human_readable_size(n_bytes)}", file=output)
+
+        # Write the SLURM script
+        with open(outfile, 'w') as script_file:
+            script_file.write(script)
+
+        if prediction:
+            print(f"\n\nThe transfer is predicted to take {human_readable_time(prediction['seconds'])}, the job will be allowed to run for {prediction['walltime']}.", file=output)
+
+        print(msg('gen_outro', outfile=outfile, rsync_command=rsync_command), file=output)
+
+    return {'local_dir': os.path.abspath(local_dir), 'remote_dir': remote_dir, 'outfile': outfile, 'written': not args.dryrun,
+            'sbatch_options': sbatch_options, 'rsync_command': rsync_command, 'streams': args.partitions,
+            'prediction': prediction, 'script': script}
+
+
+def gen_slurm_script(args):
+    """ The gen command, asks for the options that were not given and runs plan_transfer() """
+
+    # with --json stdout only gets the plan as a line of JSON, the messages go to stderr
+    output = sys.stderr if args.json else sys.stdout
+
+    # print intro message
+    print(msg('gen_intro'), file=output)
+
+    # ask for what was not given on the command line
+    local_dir = args.local_dir
     while not local_dir:
-        local_dir = args.local_dir or input(msg('input_local_dir'))
+        local_dir = ask(args, 'input_local_dir')
         # make sure it is a valid directory
-        if local_dir:
-            local_dir = os.path.expanduser(local_dir)
-            if not os.path.isdir(local_dir):
-                print(f"ERROR: not a valid directory, {local_dir}")
-                local_dir = None
+        if local_dir and not os.path.isdir(os.path.expanduser(local_dir)):
+            print(f"ERROR: not a valid directory, {local_dir}", file=output)
+            local_dir = None
 
-    slurm_account = None
+    slurm_account = args.slurm_account
     while not slurm_account:
-        slurm_account = args.slurm_account or input(msg("input_slurm_account"))
+        slurm_account = ask(args, "input_slurm_account")
 
-    cluster = None
-    cluster = args.cluster or input(msg("input_cluster")) or cluster_default
-    if cluster not in ['rackham', 'snowy']:
-        print(f"WARNING: Cluster not rackham or snowy, {cluster}")
+    cluster = args.cluster or ask(args, "input_cluster") or 'rackham'
 
-    username = None
+    username = args.username
     while not username:
-        username = args.username or input(msg("input_username"))
-
-    # don't ask for a hostname, but leave it open to specify another one on commandline
-    hostname      = args.hostname or hostname_default
+        username = ask(args, "input_username")
 
-    remote_dir = None
+    remote_dir = args.remote_dir
     while not remote_dir:
-        remote_dir = args.remote_dir or input(msg("input_remote_dir"))
+        remote_dir = ask(args, "input_remote_dir")
 
-    ssh_key = None
+    # a key given on the command line is not asked for again, plan_transfer() reports it if it does not exist
+    ssh_key_default = f"{os.environ['HOME']}/id_ed25519_pdc"
+    ssh_key = args.ssh_key
     while not ssh_key:
-        ssh_key  = args.ssh_key  or input(msg("input_ssh_key")) or ssh_key_default
-        # make sure the file exists
-        if ssh_key:
-            ssh_key = os.path.expanduser(ssh_key)
-            if not os.path.isfile(ssh_key):
-                print(f"ERROR: file does not exists, {ssh_key}")
-                ssh_key = None
-
-    outfile_default  = f"~/darsync_{os.path.basename(os.path.abspath(local_dir))}.slurm"
-
-    outfile = args.outfile or input(msg("input_outfile", outfile_default=outfile_default)) or outfile_default
-    outfile = os.path.abspath(os.path.expanduser(outfile))
-
-    if args.dryrun:
-        print(f"""
+        ssh_key = ask(args, "input_ssh_key") or ssh_key_default
+        if not os.path.isfile(os.path.expanduser(ssh_key)):
+            print(f"ERROR: file does not exists, {ssh_key}", file=output)
+            ssh_key = None
+
+    outfile_default = f"~/darsync_{os.path.basename(os.path.abspath(local_dir))}.slurm"
+    outfile = args.outfile or ask(args, "input_outfile", outfile_default=outfile_default) or outfile_default
+
+    plan = plan_transfer(**dict(vars(args), local_dir=local_dir, remote_dir=remote_dir, slurm_account=slurm_account, username=username,
+                                ssh_key=ssh_key, cluster=cluster, outfile=outfile, output=output))
+    if args.json:
+        print(json.dumps(plan))
+    return plan
+
+
+
+def apply_ownership(batch):
+    """ Set the mode, owner and group of a batch of entries and return the number changed and the errors """
+    changed = 0
+    errors  = []
+    for path, mode, st_mode, uid, gid in batch:
+        try:
+            # symlinks have no mode of their own, and the text format does not say what is a symlink
+            if st_mode is None:
+                st_mode = os.lstat(path).st_mode
+            if uid != -1 or gid != -1:
+                os.lchown(path, uid, gid)
+            if not stat.S_ISLNK(st_mode):
+                os.chmod(path, mode)
+            changed += 1
+        except OSError as e:
+            errors.append(f"{os.fsdecode(path)}: {e.strerror}")
+    return changed, errors
+
+
+
+def read_id_map(items):
+    """ Parse OLD:NEW id pairs, where NEW can be a user or group name """
+    id_map = {}
+    for item in items or []:
+        old, _, new = item.partition(':')
+        id_map[int(old)] = new
+    return id_map
+
+
+
+def restore_ownership(args):
+    """ Apply the modes, groups and owners in an ownership file written by check to the transferred files """
+
+    dest_dir = os.fsencode(os.path.abspath(os.path.expanduser(args.dest_dir)))
+
+    # translate names in the id maps to this system's ids
+    try:
+        uid_map = {old: int(new) if new.isdigit() else pwd.getpwnam(new).pw_uid for old, new in read_id_map(args.uid_map).items()}
+        gid_map = {old: int(new) if new.isdigit() else grp.getgrnam(new).gr_gid for old, new in read_id_map(args.gid_map).items()}
+    except (KeyError, ValueError) as e:
+        sys.exit(f"ERROR: invalid id mapping, {e}")
+
+    # only root can give files away, others can only set the group to one of their own
+    is_root   = os.geteuid() == 0
+    my_groups = set(os.getgroups()) | {os.getegid()}
+    if uid_map and not is_root:
+        print("WARNING: only root can change the owner of files, the --uid-map is ignored.")
+
+    def new_ids(uid, gid):
+        gid = gid_map.get(gid, gid)
+        return uid_map.get(uid, uid) if is_root else -1, gid if is_root or gid in my_groups else -1
+
+    changed  = 0
+    errors   = []
+    in_flight = deque()
+    dirs     = []
+
+    def finish(future):
+        nonlocal changed
+        batch_changed, batch_errors = future.result()
+        changed += batch_changed
+        errors.extend(batch_errors)
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        batch = []
+        for rel_path, mode, st_mode, uid, gid, is_dir in read_ownership(args.ownership_file):
+            entry = (os.path.join(dest_dir, rel_path) if rel_path else dest_dir, mode, st_mode, *new_ids(uid, gid))
+            if args.dryrun:
+                changed += 1
+                continue
+
+            # directories last, so taking away permissions from one does not stop the rest
+            if is_dir:
+                dirs.append(entry)
+                continue
+            batch.append(entry)
+            if len(batch) >= args.batch_size:
+                in_flight.append(executor.submit(apply_ownership, batch))
+                batch = []
+                while len(in_flight) > args.jobs * 2:
+                    finish(in_flight.popleft())
+        in_flight.append(executor.submit(apply_ownership, batch))
+        while in_flight:
+            finish(in_flight.popleft())
+
+        # deepest directories first
+        dirs.sort(key=lambda entry: entry[0].count(b'/'), reverse=True)
+        for i in range(0, len(dirs), args.batch_size):
+            in_flight.append(executor.submit(apply_ownership, dirs[i:i + args.batch_size]))
+        while in_flight:
+            finish(in_flight.popleft())
+
+    for error in errors[:20]:
+        print(f"ERROR: {error}")
+    if len(errors) > 20:
+        print(f"... and {len(errors) - 20} more errors")
+
+    print(f"\n{'Would restore' if args.dryrun else 'Restored'} the ownership of {changed} files and directories in {os.fsdecode(dest_dir)}, {len(errors)} failed.")
+    if errors:
+        sys.exit(1)
 
 
 
-Dry run.
-Would have created SLURM script: {outfile}
+def benchmark_check(args):
+    """ Run the check on a synthetic tree and report the measurements as JSON """
+    from concurrent.futures import ProcessPoolExecutor
 
-containing the this:
+    params = {'depth': args.depth, 'fanout': args.fanout, 'files_per_dir': args.files_per_dir, 'distribution': args.distribution,
+              'extensions': args.extensions, 'mean_file_size': args.mean_file_size, 'crowded_dirs': args.crowded_dirs,
+              'crowded_files': args.crowded_files, 'seed': args.seed}
 
-#!/bin/bash -l
-#SBATCH -A {slurm_account}
-#SBATCH -M {cluster}
-#SBATCH -t 10-00:00:00
-#SBATCH -p core
-#SBATCH -n 1
-#SBATCH -J darsync_{os.path.basename(os.path.abspath(local_dir))}
-#SBATCH --output={os.path.abspath(os.path.expanduser("~/"))}/darsync_{os.path.basename(os.path.abspath(local_dir))}.out
-#SBATCH --error={os.path.abspath(os.path.expanduser("~/"))}/darsync_{os.path.basename(os.path.abspath(local_dir))}.err
+    work_dir = tempfile.mkdtemp(prefix="darsync_bench_")
+    tree     = os.path.abspath(os.path.expanduser(args.tree)) if args.tree else os.path.join(work_dir, "tree")
+    params_path = os.path.join(tree, BENCH_PARAMS_FILE)
 
-rsync -e "ssh -i {os.path.abspath(ssh_key)} -o StrictHostKeyChecking=no" -acPuv {os.path.abspath(local_dir)}/ {username}@{hostname}:{remote_dir}
+    try:
+        # generate the tree unless it already exists with the same parameters
+        tree_info = None
+        if os.path.isfile(params_path):
+            with open(params_path) as f:
+                tree_info = json.load(f)
+            if tree_info['params'] != params:
+                sys.exit(f"ERROR: {tree} was generated with other parameters, remove it or use another --tree.")
+            print(f"Reusing the tree in {tree}", file=sys.stderr)
+        elif os.path.isdir(tree) and os.listdir(tree):
+            sys.exit(f"ERROR: {tree} is not empty and was not generated by the benchmark.")
+        else:
+            print(f"Generating the tree in {tree}", file=sys.stderr)
+            start = time.perf_counter()
+            n_dirs, n_files, total_size = generate_tree(tree, **params)
+            tree_info = {'params': params, 'dirs': n_dirs, 'files': n_files, 'total_size': total_size, 'generate_seconds': time.perf_counter() - start}
+            with open(params_path, 'w') as f:
+                json.dump(tree_info, f)
+
+        runs = []
+        for mode in args.modes:
+            for jobs in args.jobs:
+                for repeat in range(args.repeat):
+                    # the index mode measures a rerun, so build the index first
+                    prefix     = os.path.join(work_dir, f"darsync_bench_{mode}_{jobs}_{repeat}")
+                    check_options = dict(local_dir=tree, prefix=prefix, jobs=jobs, no_index=mode == 'scan',
+                                         low_memory=mode == 'low-memory', max_ops=args.max_ops, adaptive=args.adaptive,
+                                         latency_tolerance=args.latency_tolerance, fake_latency=args.fake_latency)
+                    passes = 2 if mode == 'index' else 1
+                    for _ in range(passes):
+                        # a fresh process for each run, so earlier runs do not affect the peak RSS
+                        with ProcessPoolExecutor(max_workers=1) as executor:
+                            result = executor.submit(benchmark_run, check_options).result()
+                    os.remove(ownership_file_path(tree, prefix))
+
+                    result['files_per_second'] = tree_info['files'] / result['seconds']
+                    result.update(mode=mode, jobs=jobs, repeat=repeat)
+                    runs.append(result)
+                    print(f"{mode} jobs={jobs} run {repeat + 1}/{args.repeat}: {result['seconds']:.2f} s, {result['files_per_second']:.0f} files/s", file=sys.stderr)
+    finally:
+        if args.keep:
+            print(f"Kept the check results in {work_dir}", file=sys.stderr)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
 
-""")
+    report = {'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'host': platform.node(), 'python': platform.python_version(),
+              'cpus': os.cpu_count(), 'tree': tree_info, 'runs': runs}
 
+    # append to the results file, one JSON document per line, so results can be compared over time
+    if args.outfile == '-':
+        print(json.dumps(report, indent=2))
     else:
-        # Write the SLURM script
-        with open(outfile, 'w') as script:
-            script.write(f"""#!/bin/bash -l
-#SBATCH -A {slurm_account}
-#SBATCH -M {cluster}
-#SBATCH -t 10-00:00:00
-#SBATCH -p core
-#SBATCH -n 1
-#SBATCH -J darsync_{os.path.basename(os.path.abspath(local_dir))}
-#SBATCH --output={os.path.abspath(os.path.expanduser("~/"))}/darsync_{os.path.basename(os.path.abspath(local_dir))}.out
-#SBATCH --error={os.path.abspath(os.path.expanduser("~/"))}/darsync_{os.path.basename(os.path.abspath(local_dir))}.err
-
-rsync -e "ssh -i {os.path.abspath(ssh_key)} -o StrictHostKeyChecking=no" -acPuv {os.path.abspath(local_dir)}/ {username}@{hostname}:{remote_dir}
-""")
+        with open(args.outfile, 'a') as f:
+            f.write(json.dumps(report) + "\n")
+        print(f"Results appended to {args.outfile}", file=sys.stderr)
+
+
+
+def link_run(files, payload_dir, list_dir, destination, ssh, compress, streams):
+    """ Send the payload with streams concurrent rsync processes and return the seconds it took, or None if any failed """
+    # give each file to the stream with the fewest bytes so far, largest files first
+    lists = [[] for _ in range(streams)]
+    sizes = [0] * streams
+    for relpath, size in sorted(files, key=lambda file: file[1], reverse=True):
+        i = sizes.index(min(sizes))
+        lists[i].append(relpath)
+        sizes[i] += size
+
+    commands = []
+    for i, relpaths in enumerate(lists):
+        list_path = os.path.join(list_dir, f"files.{i}")
+        with open(list_path, 'w') as f:
+            f.write("".join(f"{relpath}\n" for relpath in relpaths))
+        command = ["rsync", "-a", f"--files-from={list_path}"] + (["-z"] if compress else []) + (["-e", ssh] if ssh else [])
+        commands.append(command + [f"{payload_dir}/", destination])
+
+    start = time.perf_counter()
+    processes = [subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE) for command in commands]
+    failed = False
+    for process in processes:
+        stderr = process.communicate()[1]
+        if process.returncode != 0:
+            print(stderr.decode(errors='replace'), file=sys.stderr)
+            failed = True
+    seconds = time.perf_counter() - start
+    return None if failed else seconds
+
+
+
+def benchmark_link(args):
+    """ Measure the transfer rate to the remote system and save the best settings in the transfer model """
+    size_mix   = parse_size_mix(args.file_sizes)
+    work_dir   = tempfile.mkdtemp(prefix="darsync_bench_link_")
+    empty_dir  = os.path.join(work_dir, "empty")
+    os.makedirs(empty_dir)
+
+    # send to a scratch directory on the remote side, over ssh or to an rsync daemon
+    if args.daemon:
+        destination = f"{args.daemon.rstrip('/')}/darsync_bench_link/"
+        ciphers     = [None]
+        ssh_base    = None
+    else:
+        if not args.remote_dir:
+            sys.exit("ERROR: give the directory on the remote system to send the test files to with --remote-dir, or an rsync daemon with --daemon")
+        destination = f"{args.username + '@' if args.username else ''}{args.hostname}:{args.remote_dir.rstrip('/')}/darsync_bench_link/"
+        ciphers     = args.ciphers
+        ssh_base    = "ssh -o StrictHostKeyChecking=no" + (f" -i {os.path.abspath(os.path.expanduser(args.ssh_key))}" if args.ssh_key else "") + (f" -p {args.port}" if args.port else "")
+    compress_modes = {'off': [False], 'on': [True], 'both': [False, True]}[args.compress]
+
+    def ssh_command(cipher):
+        return ssh_base + (f" -c {cipher}" if cipher and cipher != 'default' else "") if ssh_base else None
+
+    def clean(ssh):
+        # empty the scratch directory, the same way for ssh and rsync daemons
+        subprocess.run(["rsync", "-r", "--delete"] + (["-e", ssh] if ssh else []) + [f"{empty_dir}/", destination], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    runs = []
+    try:
+        print(f"Generating the test files in {work_dir}", file=sys.stderr)
+        files   = generate_payload(os.path.join(work_dir, "payload"), size_mix, args.content, args.seed)
+        n_bytes = sum(size for relpath, size in files)
+        small   = generate_payload(os.path.join(work_dir, "small"), [(0, args.small_files)], args.content, args.seed) if args.small_files else []
+
+        print(f"\n{'streams':>7}  {'cipher':<30} {'compress':<8} {'seconds':>8} {'MB/s':>8} {'files/s':>8}", file=sys.stderr)
+        for cipher in ciphers:
+            for compress in compress_modes:
+                for streams in args.streams:
+                    best = None
+                    for repeat in range(args.repeat):
+                        clean(ssh_command(cipher))
+                        seconds = link_run(files, os.path.join(work_dir, "payload"), work_dir, destination, ssh_command(cipher), compress, streams)
+                        if seconds is not None and (best is None or seconds < best):
+                            best = seconds
+                    if best is None:
+                        print(f"{streams:>7}  {cipher or 'daemon':<30} {'on' if compress else 'off':<8} failed", file=sys.stderr)
+                        continue
+                    runs.append({'streams': streams, 'cipher': cipher, 'compress': compress, 'seconds': best, 'bytes_per_second': n_bytes / best, 'files_per_second': len(files) / best})
+                    print(f"{streams:>7}  {cipher or 'daemon':<30} {'on' if compress else 'off':<8} {best:>8.2f} {n_bytes / best / 1024 ** 2:>8.1f} {len(files) / best:>8.1f}", file=sys.stderr)
+
+        if not runs:
+            sys.exit("ERROR: all transfers failed, check that rsync works with the given remote system")
+
+        # the cipher and compression with the highest rate, and the fewest streams that get within 5% of it
+        best_rate = max(run['bytes_per_second'] for run in runs)
+        best      = max(runs, key=lambda run: run['bytes_per_second'])
+        settings  = [run for run in runs if run['cipher'] == best['cipher'] and run['compress'] == best['compress']]
+        enough    = min((run for run in settings if run['bytes_per_second'] >= 0.95 * best_rate), key=lambda run: run['streams'])
+        single    = min(settings, key=lambda run: run['streams'])
+
+        # the cost of each file, from sending empty files with a single stream
+        per_file_overhead = None
+        if small:
+            clean(ssh_command(best['cipher']))
+            seconds = link_run(small, os.path.join(work_dir, "small"), work_dir, destination, ssh_command(best['cipher']), best['compress'], 1)
+            if seconds is not None:
+                per_file_overhead = seconds / len(small)
+        clean(ssh_command(best['cipher']))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    profile = {'bandwidth': single['bytes_per_second'] / single['streams'], 'link_bandwidth': best_rate, 'max_streams': enough['streams'],
+               'ssh_cipher': None if best['cipher'] in (None, 'default') else best['cipher'], 'rsync_compress': best['compress']}
+    if per_file_overhead is not None:
+        profile['per_file_overhead'] = per_file_overhead
+    print(f"\nBest: {enough['streams']} streams, cipher {best['cipher'] or 'daemon'}, compression {'on' if best['compress'] else 'off'}, {best_rate / 1024 ** 2:.1f} MB/s", file=sys.stderr)
 
-        print(msg('gen_outro', outfile=outfile, ssh_key=os.path.abspath(ssh_key), local_dir=os.path.abspath(local_dir), username=username, hostname=hostname, remote_dir=remote_dir))
+    if args.dryrun:
+        print(json.dumps(profile, indent=2))
+        return
+
+    # save the profile in the transfer model file, in the section of the cluster if one is given
+    profile_path = os.path.expanduser(args.profile)
+    values = {}
+    if os.path.isfile(profile_path):
+        with open(profile_path) as f:
+            values = json.load(f)
+    section = values.setdefault(args.cluster, {}) if args.cluster else values
+    section.update(profile)
+    section['bench_link'] = {'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'host': platform.node(), 'destination': destination, 'file_sizes': args.file_sizes, 'content': args.content, 'runs': runs}
+    with open(profile_path, 'w') as f:
+        json.dump(values, f, indent=2)
+    print(f"Saved the transfer profile in {profile_path}, gen uses it to choose the ssh cipher, rsync compression and, with --auto-partitions, the number of streams.", file=sys.stderr)
+
+
+
+def batch_check_project(check_options, log_path):
+    """ Check a project with the output written to a log file, and return the summary, or the error if it failed """
+    with open(log_path, 'w') as log:
+        # any failure is recorded rather than stopping the other projects
+        try:
+            return scan(output=log, **check_options)
+        except (Exception, SystemExit) as e:
+            print(f"\nERROR: {e}", file=log)
+            return {'local_dir': check_options['local_dir'], 'prefix': check_options['prefix'], 'error': str(e)}
+
+
+
+def batch_check(args):
+    """ Check many projects concurrently and write a summary of them as JSON and CSV """
+    import csv
+    from concurrent.futures import ProcessPoolExecutor
+
+    # expand the globs and read the list of project roots
+    patterns = list(args.roots)
+    if args.list:
+        with open(args.list) as f:
+            patterns.extend(line.strip() for line in f if line.strip())
+    roots = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(os.path.expanduser(pattern))) or [pattern]
+        roots.extend(os.path.abspath(path) for path in matches if os.path.abspath(path) not in roots)
+    if not roots:
+        sys.exit("ERROR: no project directories given.")
+
+    # fail early rather than in every project
+    if args.rules:
+        try:
+            Classifier(rules_file=args.rules)
+        except (OSError, ValueError) as e:
+            sys.exit(f"ERROR: could not read the classifier rules, {e}")
+    try:
+        read_transfer_model(args.model, args.cluster or 'rackham')
+    except (OSError, ValueError) as e:
+        sys.exit(f"ERROR: could not read the transfer model, {e}")
+
+    outdir = os.path.abspath(os.path.expanduser(args.outdir))
+    os.makedirs(outdir, exist_ok=True)
+
+    # with --json stdout only gets the results of the projects, one line of JSON each as they finish
+    report = sys.stderr if args.json else sys.stdout
+
+    # one prefix per project, made unique if projects share a name
+    projects = []
+    used     = set()
+    for root in roots:
+        if not os.path.isdir(root):
+            print(f"WARNING: skipping {root}, not a directory", file=report)
+            continue
+        name = os.path.basename(root) or "root"
+        unique_name = name
+        n = 1
+        while unique_name in used:
+            n += 1
+            unique_name = f"{name}_{n}"
+        used.add(unique_name)
+        check_options = dict(local_dir=root, prefix=os.path.join(outdir, f"darsync_{unique_name}"), jobs=args.jobs,
+                             no_index=args.no_index, file_list=args.file_list, rules=args.rules,
+                             ownership_format=args.ownership_format, ownership_dir=outdir, max_ops=args.max_ops, adaptive=args.adaptive,
+                             model=args.model, cluster=args.cluster)
+        projects.append((os.stat(root).st_dev, check_options))
+
+    # start projects in the given order as long as there are free processes and their file system is not at its cap
+    results  = []
+    running  = {}
+    per_fs   = collections.Counter()
+    queue    = deque(projects)
+    with ProcessPoolExecutor(max_workers=args.processes) as executor:
+        while queue or running:
+            for _ in range(len(queue)):
+                if len(running) >= args.processes:
+                    break
+                fs, check_options = queue.popleft()
+                if per_fs[fs] >= max(args.per_fs, 1):
+                    queue.append((fs, check_options))
+                    continue
+                per_fs[fs] += 1
+                running[executor.submit(batch_check_project, check_options, f"{check_options['prefix']}.log")] = fs, check_options
+
+            done, pending = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                fs, check_options = running.pop(future)
+                per_fs[fs] -= 1
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # the process of the project died, e.g. killed for using too much memory
+                    result = {'local_dir': check_options['local_dir'], 'prefix': check_options['prefix'], 'error': str(e) or type(e).__name__}
+                results.append(result)
+                if args.json:
+                    print(json.dumps(result), flush=True)
+                if 'error' in result:
+                    print(f"[{len(results)}/{len(projects)}] {result['local_dir']}: ERROR, {result['error']}", file=report)
+                else:
+                    print(f"[{len(results)}/{len(projects)}] {result['local_dir']}: {result['files']} files, {human_readable_size(result['bytes'])}, about {human_readable_time(result['estimated_transfer_seconds'])} to transfer", file=report)
+
+    # the most expensive projects first, so the migrations can be scheduled by cost
+    results.sort(key=lambda result: result.get('estimated_transfer_seconds', -1), reverse=True)
+    fields = ['local_dir', 'files', 'bytes', 'crowded_dirs', 'uncompressed_files', 'uncompressed_bytes', 'large_uncompressed_files', 'estimated_transfer_seconds',
+              'hard_link_groups', 'hard_link_bytes', 'duplicate_bytes', 'prefix', 'error']
+    totals = {field: sum(result.get(field, 0) for result in results) for field in fields[1:-2]}
+    with open(os.path.join(outdir, "darsync_batch.json"), 'w') as f:
+        json.dump({'projects': results, 'totals': totals, 'failed': sum('error' in result for result in results)}, f, indent=2)
+    with open(os.path.join(outdir, "darsync_batch.csv"), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        # only the declared columns, the summaries have more keys than fit in a table
+        writer.writerows({field: result.get(field) for field in fields} for result in results)
+
+    print(f"""
+Checked {len(results)} projects, {sum('error' in result for result in results)} failed.
+{totals['files']} files, {human_readable_size(totals['bytes'])} in total, about {human_readable_time(totals['estimated_transfer_seconds'])} to transfer as single streams.
+
+The results of each project are in {outdir}/darsync_<project>.*, and the summary of
+all projects, most expensive to transfer first, in {outdir}/darsync_batch.json and .csv
+""", file=report)
 
 
 
@@ -549,75 +3637,600 @@ Content of the public key:
     # print intro message
     print(msg('sshkey_outro'))
 
-# Set up argument parser and subcommands
-parser = argparse.ArgumentParser()
-subparsers = parser.add_subparsers()
-
-# 'check' subcommand
-parser_check = subparsers.add_parser('check', description='Checks if a file tree contains uncompressed file formats or too many files.')
-parser_check.add_argument('-l', '--local-dir', help='Path to directory to check.')
-parser_check.add_argument('-p', '--prefix', help='Path and prefix to where log files should be created. (default: ~/darsync_foldername)')
-parser_check.add_argument('-d', '--devel', action="store_true", help='Trigger all warnings.')
-parser_check.set_defaults(func=check_file_tree)
-
-# 'gen' subcommand
-parser_gen = subparsers.add_parser('gen', description='Generates a SLURM script file containing a rsync command')
-parser_gen.add_argument('-l', '--local-dir', help='Path to local directory to transfer.')
-parser_gen.add_argument('-r', '--remote-dir', help='Path to the destination directory on the remote system.')
-parser_gen.add_argument('-A', '--slurm-account', help='Which SLURM account to run the job as (UPPMAX proj id).')
-parser_gen.add_argument('-M', '--cluster', help='Which cluster to run the job on (default: rackham).')
-parser_gen.add_argument('-u', '--username', help='The username at the remote system.')
-parser_gen.add_argument('-H', '--hostname', help='The hostname of the remote system. (default dardel.pdc.kth.se)', default="dardel.pdc.kth.se")
-parser_gen.add_argument('-s', '--ssh-key', help='Path to the private SSH key to use when logging in to the remote system.')
-parser_gen.add_argument('-o', '--outfile', help='Path to the SLURM script to create.')
-parser_gen.add_argument('-d', '--dryrun', action="store_true", help='Dry run, do not actually create the SLURM script.')
-parser_gen.set_defaults(func=gen_slurm_script)
-
-# 'sshkey' subcommand
-parser_sshkey = subparsers.add_parser('sshkey', description='Generates a SSH key pair that can be used to login to Dardel.')
-parser_sshkey.add_argument('-o', '--output', help='Path to where the key will be created. (deafult: ~/id_ed25519_pdc)')
-parser_sshkey.set_defaults(func=create_ssh_keys)
-
-# Parse command line arguments
-args = parser.parse_args()
-
-
-# ask interactively if no subcommand was sent
-if 'func' not in args:
-    # If no subcommand given, print help message and exit
-    func = input(msg("script_intro"))
-
-    # ask for subcommand until a valid one is given
-    run = True
-    while run:
-        if func == 'gen':
-            run = False
-            # init a argparse namespace to get the correct defaults etc
-            subcommand_namespace = parser_gen.parse_args()
-            args.__dict__.update(subcommand_namespace.__dict__)
-
-            # call the generate function
-            gen_slurm_script(args)
-        elif func == 'check':
-            run = False
-            # init a argparse namespace to get the correct defaults etc
-            subcommand_namespace = parser_check.parse_args()
-            args.__dict__.update(subcommand_namespace.__dict__)
-
-            # call the generate function
-            check_file_tree(args)
-        elif func == 'sshkey':
-            run = False
-            # init a argparse namespace to get the correct defaults etc
-            subcommand_namespace = parser_sshkey.parse_args()
-            args.__dict__.update(subcommand_namespace.__dict__)
+def create_manifest(args):
+    """ Write a checksum manifest of a directory tree """
+
+    local_dir = os.path.abspath(os.path.expanduser(args.local_dir))
+    if not os.path.isdir(local_dir):
+        print(f"ERROR: not a valid directory, {local_dir}", file=sys.stderr)
+        sys.exit(1)
+
+    # '-' writes to stdout, which is how the manifest on the remote side is collected
+    outfile = sys.stdout.buffer if args.outfile == '-' else os.path.abspath(os.path.expanduser(args.outfile))
+    # directories that are transferred some other way, e.g. packed crowded directories
+    exclude_dirs = set()
+    if args.exclude_dirs:
+        with open(args.exclude_dirs, 'rb') as dirs_file:
+            exclude_dirs = set(rel_dir for rel_dir in dirs_file.read().split(b'\0') if rel_dir)
+
+    n_files, n_bytes = write_manifest(local_dir, outfile, jobs=args.jobs, chunk_size=args.chunk_size, exclude_dirs=exclude_dirs, hash_files=not args.no_hash)
+
+    print(f"{'Listed' if args.no_hash else 'Hashed'} {n_files} files, {human_readable_size(n_bytes)}, in {local_dir}", file=sys.stderr)
+
+
+
+def verify_manifests(args):
+    """ Compare a local and a remote checksum manifest and list the files that have to be sent again """
+
+    local_chunk_size,  local_records  = read_manifest(args.local_manifest)
+    remote_chunk_size, remote_records = read_manifest(args.remote_manifest)
+    if local_chunk_size != remote_chunk_size:
+        print(f"ERROR: the manifests were created with different chunk sizes, {local_chunk_size} and {remote_chunk_size}")
+        sys.exit(1)
+    if local_chunk_size == 0:
+        print("ERROR: the manifests have no checksums to verify, create them without --no-hash")
+        sys.exit(1)
+
+    n_mismatches = 0
+    with open(args.outfile, 'wb') as mismatches:
+        for relpath in compare_manifests(local_records, remote_records):
+            mismatches.write(relpath + b'\0')
+            n_mismatches += 1
+
+    print(f"{n_mismatches} files are missing or differ on the remote side, listed in {args.outfile}")
+
+
+
+def record_progress(args):
+    """ Run a transfer command and append snapshots of its rsync progress to a progress file """
+    run    = f"{platform.node()}.{os.getpid()}.{int(time.time())}"
+    job    = os.environ.get('SLURM_ARRAY_JOB_ID') and f"{os.environ['SLURM_ARRAY_JOB_ID']}_{os.environ.get('SLURM_ARRAY_TASK_ID')}" or os.environ.get('SLURM_JOB_ID')
+    latest = {'bytes': 0, 'percent': 0, 'rate': 0, 'files': 0, 'to_check': None, 'listed': None}
+
+    def snapshot(exit_code=None):
+        record = dict(latest, time=round(time.time(), 1), run=run, job=job, unit=args.unit, interval=args.interval)
+        if exit_code is not None:
+            record['exit'] = exit_code
+        # a single short append, so records from concurrent streams are not mixed up
+        with open(args.progress_file, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+
+    command = args.command[1:] if args.command[:1] == ['--'] else args.command
+    if not command:
+        sys.exit("ERROR: give the command to run after --")
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    snapshot()
+    last_snapshot = time.monotonic()
+    pending = b''
+    while True:
+        data = os.read(process.stdout.fileno(), 65536)
+        if not data:
+            break
+        # progress lines end with \r while they are updated, and with \n when a file is done
+        lines = re.split(rb'[\r\n]', pending + data)
+        pending = lines.pop()
+        for line in lines:
+            progress = parse_rsync_progress(line)
+            if progress:
+                latest.update(progress)
+            elif line.strip():
+                sys.stdout.buffer.write(line + b"\n")
+                sys.stdout.flush()
+        if time.monotonic() - last_snapshot >= args.interval:
+            snapshot()
+            last_snapshot = time.monotonic()
+
+    exit_code = process.wait()
+    snapshot(exit_code)
+    sys.exit(exit_code if exit_code >= 0 else 128 - exit_code)
+
+
+
+def transfer_status(args):
+    """ Summarize the progress of one or many transfers from the progress files of their scripts """
+
+    # the scripts or progress files given, or all transfers with the default script names
+    paths = []
+    for pattern in args.transfers or ["~/darsync_*.slurm.progress"]:
+        matches = sorted(glob.glob(os.path.expanduser(pattern))) or [os.path.expanduser(pattern)]
+        for path in matches:
+            if not path.endswith('.progress'):
+                path = f"{path}.progress"
+            paths.append(path)
+
+    summaries = []
+    for path in paths:
+        if not os.path.isfile(path):
+            print(f"WARNING: no progress file found, {path}. Was the script generated with --progress-log, and has it started?", file=sys.stderr)
+            continue
+        summary = read_progress(path)
+        summary['progress_file'] = path
+
+        # the size predicted by gen gives the time left, an upper bound since files that are already there are not sent
+        summary['predicted_bytes'] = None
+        summary['seconds_left'] = None
+        script = path[:-len('.progress')]
+        if os.path.isfile(script):
+            with open(script) as f:
+                for line in itertools.islice(f, 100):
+                    if line.startswith('# darsync-prediction '):
+                        summary['predicted_bytes'] = json.loads(line.split(' ', 2)[2])['bytes']
+        if summary['predicted_bytes'] and summary['rate']:
+            summary['seconds_left'] = max(summary['predicted_bytes'] - summary['bytes'], 0) / summary['rate']
+        summaries.append(summary)
+
+    if args.json:
+        for summary in summaries:
+            if not args.units:
+                del summary['units']
+            print(json.dumps(summary))
+        return
+
+    now = time.time()
+    print(f"{'sent':>10} {'rate':>12} {'files':>9} {'running':>7} {'done':>5} {'failed':>6} {'time left':>16} {'updated':>14}  transfer")
+    for summary in summaries:
+        rate      = f"{human_readable_size(summary['rate'])}/s" if summary['rate'] else "-"
+        time_left = human_readable_time(summary['seconds_left']) if summary['seconds_left'] is not None else "-"
+        updated   = f"{human_readable_time(now - summary['updated'])} ago" if summary['updated'] else "-"
+        print(f"{human_readable_size(summary['bytes']):>10} {rate:>12} {summary['files']:>9} {summary['running']:>7} {summary['done']:>5} {summary['failed']:>6} {time_left:>16} {updated:>14}  {summary['progress_file'][:-len('.progress')]}")
+        if args.units:
+            for name, unit in sorted(summary['units'].items()):
+                unit_rate = f"{human_readable_size(unit['rate'])}/s" if unit['rate'] else "-"
+                print(f"{human_readable_size(unit['bytes']):>10} {unit_rate:>12} {unit['files']:>9} {unit['state']:>7}    {name}")
+
+
+
+def diff_manifest_files(args):
+    """ Compare a local and a remote manifest and write the lists of new, changed and deleted files for gen --delta """
+    _, local_records  = read_manifest(args.local_manifest)
+    _, remote_records = read_manifest(args.remote_manifest)
+    outprefix = os.path.abspath(os.path.expanduser(args.outprefix))
+
+    # NUL separated lists of relative paths, like the file lists for rsync --files-from
+    totals = {kind: {'files': 0, 'bytes': 0} for kind in ('new', 'changed', 'deleted')}
+    with open(f"{outprefix}.new", 'wb') as new, open(f"{outprefix}.changed", 'wb') as changed, \
+         open(f"{outprefix}.deleted", 'wb') as deleted, open(f"{outprefix}.transfer", 'wb') as transfer:
+        lists = {'new': new, 'changed': changed, 'deleted': deleted}
+        for kind, relpath, size in diff_manifests(local_records, remote_records, args.modify_window):
+            lists[kind].write(relpath + b'\0')
+            if kind != 'deleted':
+                transfer.write(relpath + b'\0')
+            totals[kind]['files'] += 1
+            totals[kind]['bytes'] += size
+
+    summary = dict(totals, local_manifest=os.path.abspath(args.local_manifest), remote_manifest=os.path.abspath(args.remote_manifest))
+    with open(f"{outprefix}.summary.json", 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    for kind, total in totals.items():
+        print(f"{total['files']}\t{human_readable_size(total['bytes'])}\t{kind}")
+    print(f"\nThe new and changed files are listed in {outprefix}.transfer, generate a script that sends only them with\n\ndarsync gen --delta {outprefix} ...")
+
+
+
+def compress_files(args):
+    """ Compress the files listed in a prefix.uncompressed report in parallel """
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Initialize variables for tracking progress
+    jobs         = args.jobs or os.cpu_count() or 1
+    compressed   = 0
+    saved_size   = 0
+    not_smaller  = 0
+    skipped      = []
+    failed       = []
+    in_flight    = {}
+
+    def finish(future):
+        """ Replace the original with the verified compressed file, or clean up after a failure """
+        nonlocal compressed, saved_size, not_smaller
+        path, tmp_path, out_path, info = in_flight.pop(future)
+        try:
+            ok = future.result()
+        except OSError as e:
+            ok = False
+            print(f"ERROR: {path}: {e}")
+
+        # make sure the original did not change while it was compressed
+        try:
+            current = os.lstat(path)
+            unchanged = (current.st_size, current.st_mtime_ns) == (info.st_size, info.st_mtime_ns)
+        except OSError:
+            unchanged = False
+
+        if not ok or not unchanged:
+            failed.append(path)
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        if tmp_path:
+            # keep the permissions, timestamps and group of the original
+            shutil.copystat(path, tmp_path)
+            try:
+                os.chown(tmp_path, -1, info.st_gid)
+            except OSError:
+                pass
+            os.replace(tmp_path, out_path)
+        # incompressible files grow a little, they are counted separately instead of taking from the savings
+        saved = info.st_size - os.lstat(out_path).st_size
+        if saved > 0:
+            saved_size += saved
         else:
+            not_smaller += 1
+        os.remove(path)
+        compressed += 1
+        print(f"compressed {out_path}")
+
+    def wait_for_slot(limit):
+        """ Finish tasks until fewer than limit are running """
+        while len(in_flight) >= limit:
+            done, running = wait(list(in_flight), return_when=FIRST_COMPLETED)
+            for future in done:
+                finish(future)
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for path in read_uncompressed_report(args.report):
+            out_path = f"{path}.gz"
+            tmp_path = f"{out_path}.darsync-tmp"
+
+            # left over from an interrupted run
+            if os.path.exists(tmp_path) and not args.dryrun:
+                os.remove(tmp_path)
+
+            try:
+                info = os.lstat(path)
+            except OSError:
+                # already compressed by an earlier, interrupted run
+                if not os.path.exists(out_path):
+                    skipped.append((path, "file not found"))
+                continue
+
+            # compressing a symlink or a hard linked file would break the link
+            if not stat.S_ISREG(info.st_mode):
+                skipped.append((path, "not a regular file"))
+                continue
+            if info.st_nlink > 1:
+                skipped.append((path, "file has hard links"))
+                continue
+
+            if args.dryrun:
+                print(f"would compress {path}")
+                continue
+
+            wait_for_slot(jobs * 2)
+
+            if os.path.exists(out_path):
+                # an interrupted run may have stopped between creating the compressed file and
+                # removing the original, only remove it if they have the same content
+                in_flight[executor.submit(verify_compressed, path, out_path)] = (path, None, out_path, info)
+
+            elif args.format == 'bgzf' and info.st_size > 2 * COMPRESS_SEGMENT_SIZE:
+                # spread large files over all workers, segment by segment
+                segments = deque()
+                with open(tmp_path, 'wb') as out:
+                    for offset in range(0, info.st_size, COMPRESS_SEGMENT_SIZE):
+                        segments.append(executor.submit(compress_bgzf_segment, path, offset, COMPRESS_SEGMENT_SIZE, args.level))
+                        while len(segments) >= jobs * 2:
+                            out.write(segments.popleft().result())
+                    while segments:
+                        out.write(segments.popleft().result())
+                    out.write(BGZF_EOF)
+                in_flight[executor.submit(verify_compressed, path, tmp_path)] = (path, tmp_path, out_path, info)
+
+            else:
+                in_flight[executor.submit(compress_file, path, tmp_path, args.format, args.level)] = (path, tmp_path, out_path, info)
+
+        wait_for_slot(1)
+
+    for path, reason in skipped:
+        print(f"WARNING: skipped {path}, {reason}")
+    for path in failed:
+        print(f"ERROR: could not compress {path}, the original file was kept")
+
+    print(f"""
+
+Compressed {compressed} files, saving {human_readable_size(saved_size)}.
+{not_smaller} of the compressed files did not get any smaller.
+{len(skipped)} files were skipped and {len(failed)} failed.
+
+If the run was interrupted, run the same command again to continue where it stopped.
+Run `darsync check` again to update the ownership file and the reports before the transfer.
+""")
+
+
+
+def build_parser():
+    """ Set up argument parser and subcommands """
+    parser = argparse.ArgumentParser()
+    # options that are missing are asked for, except when the commands are called through the API
+    parser.set_defaults(interactive=True)
+    subparsers = parser.add_subparsers()
+
+    # 'check' subcommand
+    parser_check = subparsers.add_parser('check', description='Checks if a file tree contains uncompressed file formats or too many files.')
+    parser_check.add_argument('-l', '--local-dir', help='Path to directory to check.')
+    parser_check.add_argument('-p', '--prefix', help='Path and prefix to where log files should be created. (default: ~/darsync_foldername)')
+    parser_check.add_argument('-d', '--devel', action="store_true", help='Trigger all warnings.')
+    parser_check.add_argument('-j', '--jobs', type=int, default=1, help='Number of threads to use when listing directories. (default: 1)')
+    parser_check.add_argument('--no-index', action="store_true", help='Do not read or write the index of directory results (prefix.index) used to skip unchanged directories.')
+    parser_check.add_argument('--rescan', action="store_true", help='Ignore the index from previous runs and list all directories again.')
+    parser_check.add_argument('-e', '--estimate-compression', action="store_true", help='Estimate how much compressing the uncompressed files would save by compressing samples of them.')
+    parser_check.add_argument('--sample-budget', type=int, default=1024, help='Maximum number of MB to read when estimating compression. (default: 1024)')
+    parser_check.add_argument('--time-budget', type=int, default=300, help='Maximum number of seconds to spend estimating compression. (default: 300)')
+    parser_check.add_argument('-m', '--low-memory', action="store_true", help='Read directories one entry at a time and sort the reports, the hard links and the files compared by --dedup on disk, for trees with huge directories. Implies --jobs 1 and --no-index.')
+    parser_check.add_argument('-S', '--stats', action="store_true", help='Measure the time spent listing directories, in lstat, matching extensions and writing the ownership file, and save a summary as JSON (prefix.stats.json).')
+    parser_check.add_argument('--rules', help='File with more rules for classifying files, with a file name suffix and a category on each line, e.g. ".fastq.gz compressed". Files in the category "uncompressed" are reported.')
+    parser_check.add_argument('--sniff', action="store_true", help='Read the start of files without uncompressed file extensions to find uncompressed text files with misleading names.')
+    parser_check.add_argument('--sniff-min-size', type=int, default=1024 ** 2, help='Only read the start of files at least this many bytes large with --sniff. (default: 1048576)')
+    parser_check.add_argument('--ownership-format', choices=['text', 'binary'], default='text', help='Write the ownership file as text lines that can be read with zcat, or as compact binary records (foldername.ownership.bin.gz). Both can be applied with restore-ownership. (default: text)')
+    parser_check.add_argument('--ownership-dir', help='Directory to write the ownership file in, instead of the directory to check. It is then not transferred with the files. (default: the directory to check)')
+    parser_check.add_argument('-f', '--file-list', action="store_true", help='Write a list of everything to transfer (prefix.files.gz) that gen --file-list can give to rsync instead of letting it walk the tree again.')
+    parser_check.add_argument('--max-ops', type=float, help='Make at most this many metadata operations (directory listings and lstat calls) per second on average, to not overload a shared file system.')
+    parser_check.add_argument('-a', '--adaptive', action="store_true", help='Adapt the number of directories listed at the same time, up to --jobs, to the latency of the file system: more while it stays low, fewer when it grows.')
+    parser_check.add_argument('--latency-tolerance', type=float, default=2.0, help='With --adaptive, back off when the latency per operation gets this many times worse than the lowest seen. (default: 2.0)')
+    parser_check.add_argument('--fake-latency', help='For testing the governor: add a simulated latency of BASE_MS milliseconds per operation, growing when more than CAPACITY directories are listed at a time, given as BASE_MS:CAPACITY.')
+    parser_check.add_argument('--manifest', action="store_true", help='Write a manifest of the path, size and modification time of every file (prefix.manifest.gz), to compare with the destination with darsync diff. Implies --rescan.')
+    parser_check.add_argument('--manifest-hash', action="store_true", help='With --manifest, also read all files and save their checksums in the manifest.')
+    parser_check.add_argument('-U', '--usage', action="store_true", help='Compare the allocated size of the files (st_blocks) with their size to find sparse files, and total their size by when they were last modified and accessed, per directory (prefix.usage.gz) and for the whole tree.')
+    parser_check.add_argument('-D', '--dedup', action="store_true", help='Look for files with identical content by hashing files of the same size, and report how much removing the copies would save (prefix.duplicates).')
+    parser_check.add_argument('--dedup-min-size', type=int, default=1024 ** 2, help='Only look for copies of files at least this many bytes large with --dedup. (default: 1048576)')
+    parser_check.add_argument('--model', help='JSON file with the transfer model used to estimate the transfer time, like gen --model. (default: ~/.darsync_model.json if it exists)')
+    parser_check.add_argument('-M', '--cluster', help='Cluster whose section of the transfer model file to use, like gen --cluster. (default: rackham)')
+    parser_check.add_argument('--json', action="store_true", help='Print a line of JSON for each directory as it is checked and one with the summary when the check is done, and the messages on stderr.')
+    parser_check.set_defaults(func=check_file_tree)
+
+    # 'batch-check' subcommand
+    parser_batch = subparsers.add_parser('batch-check', description='Checks many projects concurrently and writes a summary of all of them, e.g. to schedule their migrations by cost.')
+    parser_batch.add_argument('roots', nargs='*', help='Project directories to check, or glob patterns like "/proj/naiss*".')
+    parser_batch.add_argument('-L', '--list', help='File with a project directory or glob pattern on each line.')
+    parser_batch.add_argument('-o', '--outdir', default="~/darsync_batch", help='Directory to write the results of each project and the summary in. (default: ~/darsync_batch)')
+    parser_batch.add_argument('-P', '--processes', type=int, default=4, help='Number of projects to check at the same time. (default: 4)')
+    parser_batch.add_argument('--per-fs', type=int, default=2, help='Most projects to check at the same time on the same file system. (default: 2)')
+    parser_batch.add_argument('-j', '--jobs', type=int, default=1, help='Number of threads to list directories with in each project. (default: 1)')
+    parser_batch.add_argument('--no-index', action="store_true", help='Do not read or write the index of directory results of each project.')
+    parser_batch.add_argument('-f', '--file-list', action="store_true", help='Write the list of files to transfer for each project, like check --file-list.')
+    parser_batch.add_argument('--rules', help='File with more rules for classifying files, like check --rules.')
+    parser_batch.add_argument('--max-ops', type=float, help='Metadata operations per second for each project, like check --max-ops.')
+    parser_batch.add_argument('-a', '--adaptive', action="store_true", help='Adapt the number of directories listed at the same time to the latency of the file system, like check --adaptive.')
+    parser_batch.add_argument('--ownership-format', choices=['text', 'binary'], default='text', help='Format of the ownership files, like check --ownership-format. They are written in --outdir, not in the projects. (default: text)')
+    parser_batch.add_argument('--model', help='JSON file with the transfer model used to estimate the transfer times, like gen --model. (default: ~/.darsync_model.json if it exists)')
+    parser_batch.add_argument('-M', '--cluster', help='Cluster whose section of the transfer model file to use, like gen --cluster. (default: rackham)')
+    parser_batch.add_argument('--json', action="store_true", help='Print the summary of each project as a line of JSON when it is done, and the messages on stderr.')
+    parser_batch.set_defaults(func=batch_check)
+
+    # 'gen' subcommand
+    parser_gen = subparsers.add_parser('gen', description='Generates a SLURM script file containing a rsync command')
+    parser_gen.add_argument('-l', '--local-dir', help='Path to local directory to transfer.')
+    parser_gen.add_argument('-r', '--remote-dir', help='Path to the destination directory on the remote system.')
+    parser_gen.add_argument('-A', '--slurm-account', help='Which SLURM account to run the job as (UPPMAX proj id).')
+    parser_gen.add_argument('-M', '--cluster', help='Which cluster to run the job on (default: rackham).')
+    parser_gen.add_argument('-u', '--username', help='The username at the remote system.')
+    parser_gen.add_argument('-H', '--hostname', help='The hostname of the remote system. (default dardel.pdc.kth.se)', default="dardel.pdc.kth.se")
+    parser_gen.add_argument('-s', '--ssh-key', help='Path to the private SSH key to use when logging in to the remote system.')
+    parser_gen.add_argument('-o', '--outfile', help='Path to the SLURM script to create.')
+    parser_gen.add_argument('-d', '--dryrun', action="store_true", help='Dry run, do not actually create the SLURM script.')
+    parser_gen.add_argument('-p', '--prefix', help='Path and prefix to the log files created by check, used by --partitions, --file-list and --pack-crowded. (default: ~/darsync_foldername)')
+    parser_gen.add_argument('-P', '--partitions', type=int, default=1, help='Split the transfer into this many rsync streams with balanced sizes, using the index from check. (default: 1)')
+    parser_gen.add_argument('-c', '--concurrent', action="store_true", help='Run the partitions as concurrent streams in a single job instead of a job array.')
+    parser_gen.add_argument('-f', '--file-list', action="store_true", help='Give rsync the file list written by check --file-list instead of letting it walk the tree again.')
+    parser_gen.add_argument('--chunk-files', type=int, help='With --file-list, split the list into chunks of this many files that are transferred one after another, to limit the memory rsync needs.')
+    parser_gen.add_argument('-k', '--pack-crowded', action="store_true", help='Send the crowded directories found by check (prefix.dir_n_files) as tar archives streamed over ssh, and the rest with rsync.')
+    parser_gen.add_argument('-V', '--verify', action="store_true", help='Compare files by size and modification time instead of checksums, and verify the transfer with checksum manifests of both sides afterwards.')
+    parser_gen.add_argument('-R', '--resumable', action="store_true", help='Transfer in chunks (or partitions) that are marked as done in a state directory, so a requeued job continues where it stopped, and requeue the job before the time limit. Without --partitions it uses the file list from check --file-list.')
+    parser_gen.add_argument('--signal-time', type=int, default=600, help='With --resumable, how many seconds before the time limit to stop and requeue the job. (default: 600)')
+    parser_gen.add_argument('--delta', help='Path and prefix of the lists written by darsync diff, to only send the files that are new or changed since the manifest of the destination was made.')
+    parser_gen.add_argument('--delta-delete', action="store_true", help='With --delta, also remove the files that have been deleted locally from the destination.')
+    parser_gen.add_argument('--sparse', action="store_true", help='Keep the holes in sparse files as holes on the remote system (rsync --sparse). (default: only if check --usage found sparse files, prefix.sparse)')
+    parser_gen.add_argument('--hot-first', action="store_true", help='Send the file list from check --file-list in chunks, starting with the directories with the most data modified or accessed recently and then the largest, using the totals from check --usage.')
+    parser_gen.add_argument('--hard-links', action="store_true", help='Keep hard links (rsync -H). (default: only if check found hard links, prefix.hardlinks)')
+    parser_gen.add_argument('-L', '--progress-log', action="store_true", help='Record snapshots of the progress of the transfer in a small file next to the script (outfile.progress), for darsync status, instead of logging every file.')
+    parser_gen.add_argument('--progress-interval', type=int, default=60, help='With --progress-log, seconds between the snapshots. (default: 60)')
+    parser_gen.add_argument('-t', '--time', help='Time limit of the job, e.g. 2-00:00:00. (default: predicted from the results of check with the transfer model, or 10 days without them)')
+    parser_gen.add_argument('--auto-partitions', action="store_true", help='Choose the number of concurrent streams from the results of check, so the transfer finishes within the target time of the transfer model.')
+    parser_gen.add_argument('--model', help='JSON file with the transfer model used to predict the transfer time, e.g. the bandwidth and the overhead per file. (default: ~/.darsync_model.json if it exists)')
+    parser_gen.add_argument('--json', action="store_true", help='Print the script, the rsync command and the predicted transfer time as a single line of JSON, and the messages on stderr.')
+    parser_gen.set_defaults(func=gen_slurm_script)
+
+    # 'manifest' subcommand
+    parser_manifest = subparsers.add_parser('manifest', description='Writes a gzipped checksum manifest of all files in a directory tree, used to verify transfers.')
+    parser_manifest.add_argument('-l', '--local-dir', required=True, help='Path to directory to create a manifest of.')
+    parser_manifest.add_argument('-o', '--outfile', required=True, help='Path to the manifest to create, or - to write it to stdout.')
+    parser_manifest.add_argument('-j', '--jobs', type=int, default=4, help='Number of threads to hash files with. (default: 4)')
+    parser_manifest.add_argument('--chunk-size', type=int, default=MANIFEST_CHUNK_SIZE, help=f'Size of the chunks files are hashed in, has to be the same on both sides. (default: {MANIFEST_CHUNK_SIZE})')
+    parser_manifest.add_argument('--exclude-dirs', help='NUL separated list of directories, relative to the local directory, to leave out.')
+    parser_manifest.add_argument('--no-hash', action="store_true", help='Only list the size and modification time of the files without reading them, for darsync diff.')
+    parser_manifest.set_defaults(func=create_manifest)
+
+    # 'diff' subcommand
+    parser_diff = subparsers.add_parser('diff', description='Compares a manifest of the local directory (from check --manifest or manifest) with one of the destination, and lists the files that are new, changed or deleted since, for gen --delta.')
+    parser_diff.add_argument('local_manifest', help='Manifest of the local directory.')
+    parser_diff.add_argument('remote_manifest', help='Manifest of the destination directory.')
+    parser_diff.add_argument('-o', '--outprefix', required=True, help='Path and prefix of the lists to write, outprefix.new, .changed, .deleted and .transfer (new and changed), and the totals in outprefix.summary.json.')
+    parser_diff.add_argument('--modify-window', type=int, default=1, help='Files whose modification times differ by less than this many seconds are the same, when the manifests have no checksums. (default: 1)')
+    parser_diff.set_defaults(func=diff_manifest_files)
+
+    # 'verify' subcommand
+    parser_verify = subparsers.add_parser('verify', description='Compares a local and a remote manifest and lists the files that are missing or differ on the remote side.')
+    parser_verify.add_argument('local_manifest', help='Manifest of the local directory.')
+    parser_verify.add_argument('remote_manifest', help='Manifest of the remote directory.')
+    parser_verify.add_argument('-o', '--outfile', required=True, help='Path to the NUL separated list of files to send again (rsync --from0 --files-from).')
+    parser_verify.set_defaults(func=verify_manifests)
+
+    # 'status' subcommand
+    parser_status = subparsers.add_parser('status', description='Summarizes the progress of running or finished transfers, from the progress files of scripts generated with gen --progress-log.')
+    parser_status.add_argument('transfers', nargs='*', help='SLURM scripts or their progress files, or glob patterns. (default: ~/darsync_*.slurm.progress)')
+    parser_status.add_argument('-u', '--units', action="store_true", help='Also show each partition, chunk or other unit of the transfers.')
+    parser_status.add_argument('--json', action="store_true", help='Print a line of JSON per transfer.')
+    parser_status.set_defaults(func=transfer_status)
+
+    # 'record-progress' subcommand
+    parser_record = subparsers.add_parser('record-progress', description='Runs a transfer command and appends snapshots of its rsync --info=progress2 output to a progress file. Used by scripts generated with gen --progress-log.')
+    parser_record.add_argument('progress_file', help='Progress file to append the snapshots to.')
+    parser_record.add_argument('-u', '--unit', default='transfer', help='Name of the part of the transfer the command sends. (default: transfer)')
+    parser_record.add_argument('-i', '--interval', type=int, default=60, help='Seconds between the snapshots. (default: 60)')
+    parser_record.add_argument('command', nargs=argparse.REMAINDER, help='The command to run, after -- (options to record-progress go before the progress file).')
+    parser_record.set_defaults(func=record_progress)
+
+    # 'compress' subcommand
+    parser_compress = subparsers.add_parser('compress', description='Compresses the files listed in a report created by check (prefix.uncompressed) in parallel, and removes the originals once the compressed files are verified.')
+    parser_compress.add_argument('report', help='Path to the prefix.uncompressed file created by check.')
+    parser_compress.add_argument('-j', '--jobs', type=int, help='Number of processes to compress with. (default: number of cores)')
+    parser_compress.add_argument('-F', '--format', choices=['bgzf', 'gzip'], default='bgzf', help='Compress as BGZF (bgzip compatible, large files are compressed in parallel) or plain gzip. (default: bgzf)')
+    parser_compress.add_argument('--level', type=int, default=6, help='Compression level, 1-9. (default: 6)')
+    parser_compress.add_argument('-d', '--dryrun', action="store_true", help='Dry run, only list the files that would be compressed.')
+    parser_compress.set_defaults(func=compress_files)
+
+    # 'restore-ownership' subcommand
+    parser_restore = subparsers.add_parser('restore-ownership', description='Applies the modes, groups and owners in an ownership file created by check to the transferred files, e.g. on Dardel.')
+    parser_restore.add_argument('ownership_file', help='Path to the ownership file created by check (foldername.ownership.gz or .ownership.bin.gz).')
+    parser_restore.add_argument('-d', '--dest-dir', required=True, help='Path to the transferred copy of the checked directory.')
+    parser_restore.add_argument('-u', '--uid-map', action='append', help='Map an owner to another, as OLD_UID:NEW_UID or OLD_UID:USERNAME. Can be given more than once. Only used when run as root.')
+    parser_restore.add_argument('-g', '--gid-map', action='append', help='Map a group to another, as OLD_GID:NEW_GID or OLD_GID:GROUPNAME. Can be given more than once.')
+    parser_restore.add_argument('-j', '--jobs', type=int, default=8, help='Number of threads to apply the changes with. (default: 8)')
+    parser_restore.add_argument('--batch-size', type=int, default=1000, help='Number of files each thread changes at a time. (default: 1000)')
+    parser_restore.add_argument('-n', '--dryrun', action="store_true", help='Only read the ownership file and count the entries.')
+    parser_restore.set_defaults(func=restore_ownership)
+
+    # 'bench' subcommand
+    parser_bench = subparsers.add_parser('bench', description='Benchmarks the check on a generated synthetic file tree and reports files/sec, stat calls, peak RSS and ownership file write time as JSON.')
+    parser_bench.add_argument('-t', '--tree', help='Directory to generate the tree in, or to reuse if it was generated with the same parameters. (default: a temporary directory)')
+    parser_bench.add_argument('--depth', type=int, default=4, help='Depth of the directory tree. (default: 4)')
+    parser_bench.add_argument('--fanout', type=int, default=4, help='Number of subdirectories in each directory. (default: 4)')
+    parser_bench.add_argument('--files-per-dir', type=int, default=50, help='Mean number of files in each directory. (default: 50)')
+    parser_bench.add_argument('--distribution', choices=['fixed', 'uniform', 'exponential'], default='exponential', help='Distribution of the number of files in each directory. (default: exponential)')
+    parser_bench.add_argument('--extensions', default="txt:3,fastq:2,fastq.gz:3,bam:2", help='Weighted mix of file extensions. (default: txt:3,fastq:2,fastq.gz:3,bam:2)')
+    parser_bench.add_argument('--mean-file-size', type=int, default=4096, help='Mean apparent size of the (sparse) files in bytes. (default: 4096)')
+    parser_bench.add_argument('--crowded-dirs', type=int, default=0, help='Number of directories to add --crowded-files files to. (default: 0)')
+    parser_bench.add_argument('--crowded-files', type=int, default=100000, help='Number of extra files in each crowded directory. (default: 100000)')
+    parser_bench.add_argument('--seed', type=int, default=0, help='Random seed, the same seed and parameters give the same tree. (default: 0)')
+    parser_bench.add_argument('-m', '--modes', nargs='+', choices=['scan', 'index', 'low-memory'], default=['scan'], help='Check modes to run: a full scan, a rerun with the index, or --low-memory. (default: scan)')
+    parser_bench.add_argument('-j', '--jobs', type=int, nargs='+', default=[1], help='Numbers of threads to run each mode with. (default: 1)')
+    parser_bench.add_argument('-r', '--repeat', type=int, default=3, help='Number of times to run each mode. (default: 3)')
+    parser_bench.add_argument('-o', '--outfile', default='-', help='File to append the results to as a line of JSON, or - to print them. (default: -)')
+    parser_bench.add_argument('--max-ops', type=float, help='Run the check with --max-ops.')
+    parser_bench.add_argument('-a', '--adaptive', action="store_true", help='Run the check with --adaptive.')
+    parser_bench.add_argument('--latency-tolerance', type=float, default=2.0, help='Run the check with --latency-tolerance. (default: 2.0)')
+    parser_bench.add_argument('--fake-latency', help='Run the check with --fake-latency BASE_MS:CAPACITY, to see how the governor behaves on a busy file system.')
+    parser_bench.add_argument('-k', '--keep', action="store_true", help='Keep the temporary directory with the check results, and the generated tree unless --tree was given.')
+    parser_bench.set_defaults(func=benchmark_check)
+
+    # 'bench-link' subcommand
+    parser_link = subparsers.add_parser('bench-link', description='Measures the transfer rate to the remote system with synthetic files, with different numbers of concurrent rsync streams, ssh ciphers and rsync compression, and saves the best settings as a transfer profile that gen uses.')
+    parser_link.add_argument('-r', '--remote-dir', help='Directory on the remote system to send the test files to, in a subdirectory darsync_bench_link that is emptied afterwards.')
+    parser_link.add_argument('-u', '--username', help='The username at the remote system.')
+    parser_link.add_argument('-H', '--hostname', default="dardel.pdc.kth.se", help='The hostname of the remote system. (default dardel.pdc.kth.se)')
+    parser_link.add_argument('-s', '--ssh-key', help='Path to the private SSH key to use when logging in to the remote system.')
+    parser_link.add_argument('--port', type=int, help='SSH port of the remote system, e.g. for testing against a local sshd.')
+    parser_link.add_argument('--daemon', help='Send to an rsync daemon instead of over ssh, e.g. rsync://localhost:8873/module/path. No ciphers are tried then.')
+    parser_link.add_argument('-n', '--streams', type=int, nargs='+', default=[1, 2, 4, 8], help='Numbers of concurrent rsync streams to try. (default: 1 2 4 8)')
+    parser_link.add_argument('-c', '--ciphers', nargs='+', default=['default', 'aes128-gcm@openssh.com', 'chacha20-poly1305@openssh.com'], help='ssh ciphers to try, "default" for the one ssh picks. (default: default aes128-gcm@openssh.com chacha20-poly1305@openssh.com)')
+    parser_link.add_argument('-z', '--compress', choices=['off', 'on', 'both'], default='both', help='Try the transfers without and/or with rsync compression. (default: both)')
+    parser_link.add_argument('--file-sizes', default="64M:8,1M:64,16K:256", help='Mix of test files as size:count, with K, M or G suffixes. (default: 64M:8,1M:64,16K:256)')
+    parser_link.add_argument('--content', choices=['random', 'text'], default='random', help='Fill the files with random bytes that do not compress, like already compressed data, or with FASTQ-like text. (default: random)')
+    parser_link.add_argument('--small-files', type=int, default=1000, help='Number of empty files to send to measure the cost of each file, 0 to skip it. (default: 1000)')
+    parser_link.add_argument('--repeat', type=int, default=1, help='Number of times to run each combination, the fastest run is used. (default: 1)')
+    parser_link.add_argument('--seed', type=int, default=0, help='Random seed for the content of the test files. (default: 0)')
+    parser_link.add_argument('-M', '--cluster', help='Save the profile in the section of this cluster in the profile file, e.g. rackham. (default: for all clusters)')
+    parser_link.add_argument('-p', '--profile', default="~/.darsync_model.json", help='Transfer model file to save the profile in, read by gen. (default: ~/.darsync_model.json)')
+    parser_link.add_argument('-d', '--dryrun', action="store_true", help='Only print the profile, do not save it.')
+    parser_link.set_defaults(func=benchmark_link)
+
+    # 'sshkey' subcommand
+    parser_sshkey = subparsers.add_parser('sshkey', description='Generates a SSH key pair that can be used to login to Dardel.')
+    parser_sshkey.add_argument('-o', '--output', help='Path to where the key will be created. (deafult: ~/id_ed25519_pdc)')
+    parser_sshkey.set_defaults(func=create_ssh_keys)
+
+    # the subcommand parsers by name, for command_args
+    parser.subcommands = subparsers.choices
+
+    return parser
+
+
+
+def command_args(command, **options):
+    """ The arguments of a subcommand, with the defaults of its options updated with the given options """
+    parser    = build_parser()
+    subparser = parser.subcommands.get(command)
+    if subparser is None:
+        raise ValueError(f"unknown command, {command}")
+    actions = [action for action in subparser._actions if action.dest != argparse.SUPPRESS and action.default != argparse.SUPPRESS]
+    missing = [action.dest for action in actions if action.required and action.nargs not in ('*', argparse.REMAINDER) and action.dest not in options]
+    if missing:
+        raise TypeError(f"missing options for {command}: {', '.join(missing)}")
+    # positionals that take any number of values are lists even when none are given
+    args = argparse.Namespace(**{action.dest: [] if action.default is None and action.nargs in ('*', argparse.REMAINDER) else action.default for action in actions},
+                              func=subparser.get_default('func'), interactive=parser.get_default('interactive'))
+    unknown = set(options) - set(vars(args))
+    if unknown:
+        raise TypeError(f"unknown options for {command}: {', '.join(sorted(unknown))}")
+    vars(args).update(options)
+    return args
+
+
+
+def scan(local_dir, prefix=None, output=None, on_dir=None, **options):
+    """ Check a directory tree like `darsync check` and return the summary as a dict """
+    if not local_dir or not os.path.isdir(os.path.expanduser(local_dir)):
+        raise ValueError(f"not a valid directory, {local_dir}")
+    args = command_args('check', local_dir=local_dir, prefix=prefix, **dict(options, interactive=False))
+    with open(os.devnull, 'w') if output is None else contextlib.nullcontext(output) as output:
+        return scan_file_tree(args, output, on_dir)
+
+
+
+def plan_transfer(local_dir, remote_dir, slurm_account, username, ssh_key, output=None, **options):
+    """ Plan a transfer like `darsync gen --dryrun` and return the plan as a dict """
+    if not local_dir or not os.path.isdir(os.path.expanduser(local_dir)):
+        raise ValueError(f"not a valid directory, {local_dir}")
+    if not ssh_key or not os.path.isfile(os.path.expanduser(ssh_key)):
+        raise ValueError(f"SSH key not found, {ssh_key}")
+    options.setdefault('dryrun', True)
+    args = command_args('gen', local_dir=local_dir, remote_dir=remote_dir, slurm_account=slurm_account, username=username, ssh_key=ssh_key,
+                        **dict(options, interactive=False))
+    with open(os.devnull, 'w') if output is None else contextlib.nullcontext(output) as output:
+        return plan_file_transfer(args, output)
+
+
+
+def write_slurm_script(local_dir, remote_dir, slurm_account, username, ssh_key, output=None, **options):
+    """ Plan a transfer like plan_transfer, and write the SLURM script and the file lists it uses like `darsync gen` """
+    return plan_transfer(local_dir, remote_dir, slurm_account, username, ssh_key, output=output, **dict(options, dryrun=False))
+
+
+
+def main(argv=None):
+    """ Run darsync from the command line """
+    parser = build_parser()
+
+    # Parse command line arguments
+    args = parser.parse_args(argv)
+
+    # the questions asked for missing options can complete paths with the tab key
+    if sys.stdin.isatty():
+        enable_completion()
+
+    # ask interactively if no subcommand was sent
+    if 'func' not in args:
+        # If no subcommand given, print help message and exit
+        func = input(msg("script_intro"))
+
+        # ask for subcommand until a valid one is given
+        while func not in ('gen', 'check', 'sshkey'):
             func = input(f"""
 Invalid choice.
 check/gen/sshkey? : """)
 
-else:
-    # Call the function associated with the given subcommand
-    args.func(args)
+        # init a argparse namespace to get the correct defaults etc
+        args = parser.parse_args([func])
+
+    # Call the function associated with the given subcommand, with the errors of check and gen as messages
+    try:
+        args.func(args)
+    except (ValueError, FileNotFoundError) as e:
+        sys.exit(f"ERROR: {e}")
+
 
 
+if __name__ == '__main__':
+    main()